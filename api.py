@@ -0,0 +1,197 @@
+from datetime import date, timedelta
+from functools import wraps
+
+from flask import Blueprint, Response, jsonify, request, stream_with_context
+from flask_login import current_user
+
+from db.database import session_scope
+from config import settings
+from services.analytics import ReportError, rollup_status, sales_report, sales_totals
+from services.cart import (UnknownBookError, add_item, cart_summary, decrease_item, remove_item, set_quantities,
+                           set_quantity)
+from services.exports import EXPORTS, FORMATS, ExportError, export_chunks
+from services.orders import fetch_orders_page, get_order
+from services.users import is_admin
+
+api_blueprint = Blueprint("api", __name__, url_prefix="/api")
+
+
+class ApiError(Exception):
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+@api_blueprint.errorhandler(ApiError)
+def handle_api_error(error):
+    return jsonify({'error': error.message}), error.status
+
+
+@api_blueprint.errorhandler(UnknownBookError)
+def handle_unknown_book(error):
+    return jsonify({'error': 'Книга не найдена'}), 404
+
+
+def api_login_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise ApiError('Требуется авторизация', 401)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def api_admin_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            raise ApiError('Требуется авторизация', 401)
+        if not is_admin(current_user):
+            raise ApiError('Недостаточно прав', 403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def date_arg(name, default):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ApiError(f'Параметр {name} должен быть датой в формате ГГГГ-ММ-ДД')
+
+
+def int_field(data, name, default=None):
+    value = data.get(name, default)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ApiError(f'Поле {name} должно быть целым числом')
+
+
+@api_blueprint.route('/cart', methods=['GET'])
+@api_login_required
+def get_cart():
+    with session_scope() as session:
+        return jsonify(cart_summary(session, current_user.id))
+
+
+@api_blueprint.route('/cart/items', methods=['POST'])
+@api_login_required
+def add_cart_item():
+    data = request.get_json(silent=True) or request.form
+    book_id = int_field(data, 'book_id')
+    count = int_field(data, 'count', 1)
+    if count < 1:
+        raise ApiError('Количество должно быть положительным')
+    with session_scope() as session:
+        count = add_item(session, current_user.id, book_id, count)
+    return jsonify({'book_id': book_id, 'count': count})
+
+
+@api_blueprint.route('/cart/items/<int:book_id>', methods=['PUT'])
+@api_login_required
+def set_cart_item(book_id):
+    count = int_field(request.get_json(silent=True) or request.form, 'count')
+    with session_scope() as session:
+        count = set_quantity(session, current_user.id, book_id, count)
+    return jsonify({'book_id': book_id, 'count': count})
+
+
+@api_blueprint.route('/cart/items/<int:book_id>/decrease', methods=['POST'])
+@api_login_required
+def decrease_cart_item(book_id):
+    with session_scope() as session:
+        count = decrease_item(session, current_user.id, book_id)
+    return jsonify({'book_id': book_id, 'count': count})
+
+
+@api_blueprint.route('/cart/items/<int:book_id>', methods=['DELETE'])
+@api_login_required
+def remove_cart_item(book_id):
+    with session_scope() as session:
+        remove_item(session, current_user.id, book_id)
+    return jsonify({'book_id': book_id, 'count': 0})
+
+
+@api_blueprint.route('/cart/batch', methods=['POST'])
+@api_login_required
+def batch_update_cart():
+    items = (request.get_json(silent=True) or {}).get('items')
+    if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+        raise ApiError('Ожидается список items')
+    quantities = {int_field(item, 'book_id'): int_field(item, 'count') for item in items}
+    with session_scope() as session:
+        set_quantities(session, current_user.id, quantities)
+    return jsonify({'items': [{'book_id': book_id, 'count': max(count, 0)} for book_id, count in quantities.items()]})
+
+
+@api_blueprint.route('/orders', methods=['GET'])
+@api_login_required
+def list_orders():
+    limit = min(request.args.get('limit', settings.ORDERS_PAGE_SIZE, type=int), 100)
+    with session_scope() as session:
+        orders, next_cursor = fetch_orders_page(session, current_user.id, request.args.get('cursor'), max(limit, 1))
+    return jsonify({'orders': orders, 'next_cursor': next_cursor})
+
+
+@api_blueprint.route('/orders/<int:order_id>', methods=['GET'])
+@api_login_required
+def order_detail(order_id):
+    with session_scope() as session:
+        order = get_order(session, current_user.id, order_id)
+    if not order:
+        raise ApiError('Заказ не найден', 404)
+    return jsonify(order)
+
+
+# Отчёты читают только предрасчитанные суммы sales_rollup_daily, а не orders/order_items.
+@api_blueprint.route('/reports/sales', methods=['GET'])
+@api_admin_required
+def sales_report_view():
+    date_to = date_arg('to', date.today())
+    date_from = date_arg('from', date_to - timedelta(days=29))
+    dimension = request.args.get('dimension', 'total')
+    by_day = request.args.get('by') == 'day'
+    with session_scope(readonly=True) as session:
+        try:
+            rows = sales_report(session, dimension, date_from, date_to, by_day)
+        except ReportError as error:
+            raise ApiError(str(error))
+        totals = sales_totals(session, date_from, date_to)
+        status = rollup_status(session)
+    return jsonify({
+        'dimension': dimension,
+        'from': date_from.isoformat(),
+        'to': date_to.isoformat(),
+        'rows': rows,
+        'totals': totals,
+        **status
+    })
+
+
+# Выгрузка отдаётся генератором (chunked transfer encoding): строки читаются из базы
+# пачками по мере отправки и не собираются в памяти целиком.
+@api_blueprint.route('/exports/<name>', methods=['GET'])
+@api_admin_required
+def export_view(name):
+    if name not in EXPORTS:
+        raise ApiError('Выгрузка не найдена', 404)
+    file_format = request.args.get('format', 'csv')
+    filters = {
+        'category': request.args.getlist('category'),
+        'date_from': date_arg('from', None),
+        'date_to': date_arg('to', None),
+    }
+    try:
+        chunks = export_chunks(name, file_format, filters)
+    except ExportError as error:
+        raise ApiError(str(error))
+    response = Response(stream_with_context(chunks), mimetype=FORMATS[file_format])
+    response.headers['Content-Disposition'] = f'attachment; filename={name}.{file_format}'
+    response.cache_control.private = True
+    response.cache_control.no_store = True
+    return response
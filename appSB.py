@@ -1,32 +1,55 @@
-from flask import Flask
+import time
+
+import click
+from flask import Flask, current_app
 from flask_login import LoginManager
 from sqlalchemy import inspect
 
 from config import settings
-from db.models import User
-from db.database import init_db, engine
+from db.database import init_db, engine, sync_sqlite_replicas
+from db.migrations import check_indexes, upgrade
+from scripts.import_books import import_books
 from scripts.init_data import init_books_data
+from api import api_blueprint
+from metrics import init_metrics
+from responses import init_responses
 from routes import main_blueprint
+from server import serve
+from services.analytics import backfill_sales_rollups, update_sales_rollups
+from services.bestsellers import rebuild_sales_rollup
+from services.catalog import sync_book_changes
+from services.exports import EXPORTS, FORMATS, ExportError, export_chunks
+from services.images import build_covers, cover_srcset, cover_url, placeholder_url
+from services.inventory import release_expired_reservations, set_stock, stock_missing_books
+from services.recommendations import rebuild_copurchases
+from services.reviews import recompute_ratings
+from services.users import load_user_snapshot
 from db.database import session_scope
 
-app = Flask(__name__)
-app.config['SECRET_KEY'] = settings.SECRET_KEY
-
-login_manager = LoginManager(app)
+login_manager = LoginManager()
 login_manager.login_view = 'main.login'
 
 
 @login_manager.user_loader
 def load_user(user_id):
     with session_scope() as session:
-        user = session.query(User).get(user_id)
-        if user:
-            session.expunge(user)
+        return load_user_snapshot(session, user_id)
 
-        return user
 
+def create_app():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = settings.SECRET_KEY
+    app.jinja_env.globals.update(cover_url=cover_url, cover_srcset=cover_srcset, placeholder_url=placeholder_url)
 
-app.register_blueprint(main_blueprint)
+    login_manager.init_app(app)
+    app.register_blueprint(main_blueprint)
+    app.register_blueprint(api_blueprint)
+    app.before_request(sync_book_changes)
+    init_responses(app)
+    init_metrics(app)
+    for command in COMMANDS:
+        app.cli.add_command(command)
+    return app
 
 
 def check_and_init_db():
@@ -37,7 +60,147 @@ def check_and_init_db():
         init_db()
         init_books_data()
 
+    upgrade(engine)
+    check_indexes(engine)
+    build_covers()
+
+
+@click.command('db-upgrade')
+def db_upgrade_command():
+    upgrade(engine)
+
+
+@click.command('db-check')
+def db_check_command():
+    missing, unused = check_indexes(engine)
+    click.echo(f'Missing indexes: {", ".join(missing) or "none"}')
+    click.echo(f'Unused indexes: {", ".join(unused) or "none"}')
+
+
+@click.command('replicas-sync')
+@click.option('--interval', default=None, type=float, help='Keep syncing every N seconds to emulate replication lag')
+def replicas_sync_command(interval):
+    while True:
+        try:
+            synced = sync_sqlite_replicas()
+        except ValueError as error:
+            raise click.ClickException(str(error))
+        click.echo(f'{synced} replicas synced')
+        if not interval:
+            break
+        time.sleep(interval)
+
+
+@click.command('rebuild-bestsellers')
+def rebuild_bestsellers_command():
+    with session_scope() as session:
+        rebuild_sales_rollup(session)
+
+
+@click.command('rebuild-recommendations')
+@click.option('--chunk-size', default=None, type=int, help='Orders per transaction, defaults to COPURCHASE_REBUILD_CHUNK')
+def rebuild_recommendations_command(chunk_size):
+    rebuild_copurchases(chunk_size, click.echo)
+
+
+@click.command('rollup-sales')
+@click.option('--backfill', is_flag=True, help='Rebuild rollups from the whole order history')
+@click.option('--chunk-size', default=None, type=int, help='Orders per transaction, defaults to ROLLUP_CHUNK_SIZE')
+def rollup_sales_command(backfill, chunk_size):
+    if backfill:
+        processed = backfill_sales_rollups(chunk_size, click.echo)
+    else:
+        processed = update_sales_rollups(chunk_size, progress=click.echo)
+    click.echo(f'{processed} order ids rolled up')
+
+
+@click.command('export')
+@click.argument('name', type=click.Choice(sorted(EXPORTS)))
+@click.option('--format', 'file_format', type=click.Choice(sorted(FORMATS)), default='csv', show_default=True)
+@click.option('--output', '-o', type=click.File('wb'), default='-', help='Defaults to stdout')
+@click.option('--category', multiple=True)
+@click.option('--from', 'date_from', type=click.DateTime(['%Y-%m-%d']), default=None)
+@click.option('--to', 'date_to', type=click.DateTime(['%Y-%m-%d']), default=None)
+@click.option('--batch-size', default=None, type=int, help='Rows per batch, defaults to EXPORT_BATCH_SIZE')
+def export_command(name, file_format, output, category, date_from, date_to, batch_size):
+    filters = {
+        'category': list(category),
+        'date_from': date_from.date() if date_from else None,
+        'date_to': date_to.date() if date_to else None,
+    }
+    try:
+        for chunk in export_chunks(name, file_format, filters, batch_size):
+            output.write(chunk)
+    except ExportError as error:
+        raise click.ClickException(str(error))
+
+
+@click.command('set-stock')
+@click.argument('book_id', type=int)
+@click.argument('quantity', type=int)
+def set_stock_command(book_id, quantity):
+    with session_scope() as session:
+        set_stock(session, book_id, quantity)
+
+
+@click.command('stock-missing')
+@click.option('--quantity', default=None, type=int, help='Defaults to INITIAL_STOCK')
+def stock_missing_command(quantity):
+    with session_scope() as session:
+        click.echo(f'{stock_missing_books(session, quantity)} books stocked')
+
+
+@click.command('release-reservations')
+def release_reservations_command():
+    with session_scope() as session:
+        click.echo(f'{release_expired_reservations(session)} reserved copies returned to stock')
+
+
+@click.command('recompute-ratings')
+def recompute_ratings_command():
+    with session_scope() as session:
+        recompute_ratings(session)
+
+
+@click.command('build-covers')
+def build_covers_command():
+    click.echo(f'{build_covers()} covers built')
+
+
+@click.command('import-books')
+@click.argument('path')
+@click.option('--format', 'file_format', type=click.Choice(['json', 'ndjson', 'jsonl', 'csv']))
+@click.option('--batch-size', default=1000)
+def import_books_command(path, file_format, batch_size):
+    def progress(processed, changed, rate):
+        click.echo(f'{processed} rows, {changed} changed, {rate:.0f} rows/sec')
+
+    result = import_books(path, file_format, batch_size, progress)
+    click.echo(f"Done: {result['processed']} rows, {result['changed']} changed "
+               f"in {result['seconds']:.1f}s ({result['rows_per_second']:.0f} rows/sec)")
+
+
+@click.command('serve')
+@click.option('--host', default=None, help='Defaults to APP_HOST')
+@click.option('--port', default=None, type=int, help='Defaults to APP_PORT')
+@click.option('--workers', default=None, type=int, help='Defaults to WORKERS')
+@click.option('--threads', default=None, type=int, help='Defaults to THREADS')
+def serve_command(host, port, workers, threads):
+    check_and_init_db()
+    serve(current_app._get_current_object(), host, port, workers, threads)
+
+
+COMMANDS = [db_upgrade_command, db_check_command, replicas_sync_command, rebuild_bestsellers_command,
+            rebuild_recommendations_command, rollup_sales_command, recompute_ratings_command, build_covers_command,
+            import_books_command, export_command, set_stock_command, stock_missing_command,
+            release_reservations_command, serve_command]
+
+app = create_app()
+
 
 if __name__ == '__main__':
     check_and_init_db()  # ← Только при первом запуске
-    app.run(port=settings.APP_PORT, debug=settings.DEBUG)
+    if settings.DEBUG:
+        app.run(port=settings.APP_PORT, debug=True)
+    else:
+        serve(app)
@@ -0,0 +1,78 @@
+import time
+import tracemalloc
+
+import click
+from sqlalchemy import func, select
+
+from db.database import session_scope
+from db.models import Book
+from services.read_models import BOOK_CARD_COLUMNS, BookCard
+
+
+# Прежний путь списков: полные ORM-объекты Book, скопированные в словари.
+def orm_dicts(session, limit):
+    return [{
+        'id': book.id,
+        'title': book.title,
+        'author': book.author,
+        'genre': book.genre,
+        'rating': book.rating,
+        'rating_count': book.rating_count,
+        'year': book.year,
+        'price': book.price,
+        'cover': book.cover,
+        'description': book.description
+    } for book in session.query(Book).order_by(Book.id).limit(limit)]
+
+
+def read_model_cards(session, limit):
+    return [BookCard._make(row) for row in session.execute(select(*BOOK_CARD_COLUMNS).order_by(Book.id).limit(limit))]
+
+
+LOADERS = {'orm_dicts': orm_dicts, 'read_models': read_model_cards}
+
+
+def measure(loader, limit, repeats):
+    timings = []
+    for _ in range(repeats):
+        with session_scope(readonly=True) as session:
+            started = time.perf_counter()
+            loader(session, limit)
+            timings.append(time.perf_counter() - started)
+
+    # Память считается отдельным прогоном: tracemalloc заметно замедляет код.
+    with session_scope(readonly=True) as session:
+        tracemalloc.start()
+        try:
+            rows = loader(session, limit)
+            retained, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+    count = len(rows)
+    return {
+        'rows': count,
+        'us_per_item': round(min(timings) / count * 1e6, 2),
+        'peak_bytes_per_item': round(peak / count),
+        'retained_bytes_per_item': round(retained / count),
+    }
+
+
+@click.command()
+@click.option('--rows', default=2000, show_default=True, help='Books per list')
+@click.option('--repeats', default=20, show_default=True)
+def main(rows, repeats):
+    with session_scope(readonly=True) as session:
+        if not session.scalar(select(func.count(Book.id))):
+            raise click.ClickException('Seed the database first: python -m benchmarks.seed')
+
+    results = {name: measure(loader, rows, repeats) for name, loader in LOADERS.items()}
+    for name, result in results.items():
+        click.echo(f"{name:<12} {result['us_per_item']:>8.2f} us/item  peak {result['peak_bytes_per_item']:>6} B/item  "
+                   f"retained {result['retained_bytes_per_item']:>6} B/item ({result['rows']} rows)")
+    before, after = results['orm_dicts'], results['read_models']
+    click.echo(f"read models: {after['us_per_item'] / before['us_per_item']:.0%} of CPU time, "
+               f"{after['peak_bytes_per_item'] / before['peak_bytes_per_item']:.0%} of peak memory per item")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,339 @@
+import json
+import logging
+import platform
+import random
+import threading
+import time
+from datetime import datetime
+from http.cookiejar import CookieJar
+from urllib.error import HTTPError
+from urllib.parse import urlencode
+from urllib.request import HTTPCookieProcessor, Request, build_opener
+from uuid import uuid4
+
+import click
+from sqlalchemy import func
+from werkzeug.serving import make_server
+
+from appSB import app
+from benchmarks.seed import PASSWORD, WORDS
+from config import settings
+from db.database import engine, session_scope
+from db.models import Book, User
+from metrics import request_queries
+from services.bestsellers import top_books
+from services.cache import cache
+from services.catalog import get_book_cards
+from services.facets import SORT_KEYS, facet_page
+from services.search import search_books
+
+CATEGORIES = ('fiction', 'nonfiction', 'children', 'business', 'educational', 'foreign_language', 'comics_manga')
+
+
+class TestClientDriver:
+
+    def __init__(self):
+        self.client = app.test_client()
+
+    def request(self, method, path, form=None, json_body=None):
+        response = self.client.open(path, method=method, data=form, json=json_body)
+        return response.status_code
+
+
+# Клиент для живого сервера: cookie-сессия как у браузера, редиректы не выполняются,
+# чтобы замерять сам маршрут, а не страницу, на которую он перенаправляет.
+class HttpDriver:
+
+    class NoRedirect(HTTPCookieProcessor):
+
+        def http_error_302(self, req, fp, code, msg, headers):
+            return fp
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = build_opener(self.NoRedirect(CookieJar()))
+
+    def request(self, method, path, form=None, json_body=None):
+        headers = {'Accept-Encoding': 'gzip'}
+        data = None
+        if json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        elif form is not None:
+            data = urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        try:
+            with self.opener.open(Request(self.base_url + path, data=data, method=method, headers=headers)) as response:
+                response.read()
+                return response.status
+        except HTTPError as error:
+            return error.code
+
+
+class Scenario:
+
+    def __init__(self, name, endpoint, step, prepare=None, authenticated=False):
+        self.name = name
+        self.endpoint = endpoint
+        self.step = step
+        self.prepare = prepare
+        self.authenticated = authenticated
+
+
+def random_book_id(ctx):
+    return ctx['rnd'].randint(ctx['min_book_id'], ctx['max_book_id'])
+
+
+def add_one_book(driver, ctx):
+    ctx['last_book_id'] = random_book_id(ctx)
+    driver.request('POST', '/api/cart/items', json_body={'book_id': ctx['last_book_id'], 'count': 1})
+
+
+def add_two_books(driver, ctx):
+    for _ in range(2):
+        driver.request('POST', '/api/cart/items', json_body={'book_id': random_book_id(ctx), 'count': 1})
+
+
+SCENARIOS = [
+    Scenario('home', 'main.home', lambda driver, ctx: driver.request('GET', '/')),
+    Scenario('catalog', 'main.catalog', lambda driver, ctx: driver.request(
+        'GET', '/catalog?' + urlencode({'category': ctx['rnd'].choice(CATEGORIES), 'sort': ctx['rnd'].choice(list(SORT_KEYS))}))),
+    Scenario('search', 'main.search', lambda driver, ctx: driver.request(
+        'GET', '/search?' + urlencode({'q': ctx['rnd'].choice(WORDS)}))),
+    Scenario('book_detail', 'main.book_detail', lambda driver, ctx: driver.request(
+        'GET', f'/book/{random_book_id(ctx)}')),
+    Scenario('cart_add', 'api.add_cart_item', lambda driver, ctx: driver.request(
+        'POST', '/api/cart/items', json_body={'book_id': random_book_id(ctx), 'count': 1}), authenticated=True),
+    Scenario('cart_page', 'main.cart', lambda driver, ctx: driver.request('GET', '/cart'),
+             prepare=add_two_books, authenticated=True),
+    Scenario('cart_remove', 'api.remove_cart_item', lambda driver, ctx: driver.request(
+        'DELETE', f"/api/cart/items/{ctx['last_book_id']}"), prepare=add_one_book, authenticated=True),
+    Scenario('making_an_order', 'main.making_an_order', lambda driver, ctx: driver.request(
+        'POST', '/making_an_order', form={
+            'payment_method': 'card', 'delivery_method': 'courier', 'address': 'г. Москва',
+            'full_name': 'Тест Тестов', 'idempotency_key': uuid4().hex}),
+        prepare=add_two_books, authenticated=True),
+    Scenario('submit_review', 'main.submit_review', lambda driver, ctx: driver.request(
+        'POST', '/submit_review', form={'book_id': random_book_id(ctx), 'rating': ctx['rnd'].randint(1, 5),
+                                        'review_text': 'Бенчмарк'}), authenticated=True),
+]
+
+
+def micro_scenarios(book_range):
+    # Тот же путь, что у маршрута каталога: id страницы из фасетного индекса и карточки книг.
+    def catalog_page(rnd):
+        with session_scope(readonly=True) as session:
+            book_ids, _, _ = facet_page(session, {'category': [rnd.choice(CATEGORIES)]},
+                                        rnd.choice(list(SORT_KEYS)), limit=settings.CATALOG_PAGE_SIZE)
+            get_book_cards(session, book_ids)
+
+    def search(rnd):
+        with session_scope() as session:
+            search_books(session, rnd.choice(WORDS), per_page=settings.CATALOG_PAGE_SIZE)
+
+    def book_cards(rnd):
+        with session_scope() as session:
+            get_book_cards(session, [rnd.randint(*book_range) for _ in range(20)])
+
+    def bestsellers(rnd):
+        with session_scope() as session:
+            top_books(session)
+
+    return {'facet_page': catalog_page, 'search_books': search, 'get_book_cards': book_cards,
+            'top_books': bestsellers}
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies, errors, wall_seconds, queries):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput_rps': round(len(latencies) / wall_seconds, 1) if wall_seconds else None,
+        'mean_ms': round(sum(latencies) / len(latencies) * 1000, 2) if latencies else None,
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 2) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2) if latencies else None,
+        'queries_per_request': queries,
+    }
+
+
+def endpoint_queries(endpoint):
+    series = request_queries.series.get((endpoint,))
+    return (series[1], series[2]) if series else (0.0, 0)
+
+
+def login(driver, email):
+    return driver.request('POST', '/login', form={'email': email, 'password': PASSWORD})
+
+
+def run_scenario(scenario, make_driver, requests, concurrency, seed_value, dataset, in_process):
+    per_worker = [requests // concurrency + (1 if worker < requests % concurrency else 0)
+                  for worker in range(concurrency)]
+    latencies, errors = [], []
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(concurrency + 1)
+
+    def worker(index):
+        driver = make_driver()
+        ctx = {'rnd': random.Random(seed_value * 1000 + index), 'min_book_id': dataset['book_range'][0],
+               'max_book_id': dataset['book_range'][1]}
+        if scenario.authenticated:
+            login(driver, dataset['emails'][index])
+        local_latencies, local_errors = [], 0
+        start_barrier.wait()
+        for _ in range(per_worker[index]):
+            if scenario.prepare:
+                scenario.prepare(driver, ctx)
+            started = time.perf_counter()
+            status = scenario.step(driver, ctx)
+            local_latencies.append(time.perf_counter() - started)
+            local_errors += status >= 400
+        with lock:
+            latencies.extend(local_latencies)
+            errors.append(local_errors)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    queries_before = endpoint_queries(scenario.endpoint)
+    start_barrier.wait()
+    started = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    wall_seconds = time.perf_counter() - started
+
+    queries = None
+    if in_process:
+        (sum_before, count_before), (sum_after, count_after) = queries_before, endpoint_queries(scenario.endpoint)
+        if count_after > count_before:
+            queries = round((sum_after - sum_before) / (count_after - count_before), 2)
+    return summarize(latencies, sum(errors), wall_seconds, queries)
+
+
+def run_micro(name, func, iterations, seed_value):
+    rnd = random.Random(seed_value)
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        call_started = time.perf_counter()
+        func(rnd)
+        latencies.append(time.perf_counter() - call_started)
+    return summarize(latencies, 0, time.perf_counter() - started, None)
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, current in results['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous or not previous.get('p95_ms') or not current.get('p95_ms'):
+            continue
+        p95_change = current['p95_ms'] / previous['p95_ms'] - 1
+        rps_change = (current['throughput_rps'] / previous['throughput_rps'] - 1
+                      if previous.get('throughput_rps') else 0)
+        regressed = p95_change > tolerance or rps_change < -tolerance
+        if regressed:
+            regressions.append(name)
+        click.echo(f"{name:<24} p95 {previous['p95_ms']:>9.2f} -> {current['p95_ms']:>9.2f} ms ({p95_change:+.0%})  "
+                   f"rps {previous.get('throughput_rps') or 0:>8.1f} -> {current['throughput_rps']:>8.1f} "
+                   f"({rps_change:+.0%}){'  REGRESSION' if regressed else ''}")
+    return regressions
+
+
+def dataset_info():
+    with session_scope() as session:
+        books = session.query(func.count(Book.id), func.min(Book.id), func.max(Book.id)).one()
+        users = session.query(func.count(User.id)).scalar()
+        # Каждый поток входит под своим пользователем, созданным benchmarks.seed.
+        emails = [email for email, in session.query(User.email)
+                  .filter(User.email.like('bench%@example.com')).order_by(User.id).limit(1000)]
+    return {'books': books[0], 'users': users, 'emails': emails, 'book_range': (books[1] or 1, books[2] or 1)}
+
+
+@click.command()
+@click.option('--mode', type=click.Choice(['client', 'http', 'micro']), default='client', show_default=True,
+              help='client: Flask test client; http: threaded HTTP server; micro: service functions only')
+@click.option('--url', help='Benchmark an already running server instead of an in-process one (http mode)')
+@click.option('--requests', 'requests_count', default=200, show_default=True, help='Requests per scenario')
+@click.option('--concurrency', default=4, show_default=True)
+@click.option('--scenario', 'only', multiple=True, help='Run only these scenarios')
+@click.option('--seed', 'seed_value', default=42, show_default=True)
+@click.option('--cold-cache', is_flag=True, help='Clear the application cache before every scenario')
+@click.option('--output', type=click.Path(dir_okay=False), help='Write results to this JSON file')
+@click.option('--baseline', type=click.Path(exists=True, dir_okay=False), help='Compare with a previous run')
+@click.option('--tolerance', default=0.2, show_default=True, help='Allowed p95/throughput change vs baseline')
+def main(mode, url, requests_count, concurrency, only, seed_value, cold_cache, output, baseline, tolerance):
+    app.config['WTF_CSRF_ENABLED'] = False
+    dataset = dataset_info()
+    if len(dataset['emails']) < concurrency:
+        raise click.ClickException('Seed the database first: python -m benchmarks.seed')
+
+    results = {
+        'meta': {
+            'started_at': datetime.now().isoformat(timespec='seconds'),
+            'mode': mode,
+            'url': url,
+            'dialect': engine.dialect.name,
+            'books': dataset['books'],
+            'users': dataset['users'],
+            'requests': requests_count,
+            'concurrency': concurrency,
+            'python': platform.python_version(),
+        },
+        'scenarios': {}
+    }
+
+    server = None
+    if mode == 'http' and not url:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_port}'
+
+    try:
+        if mode == 'micro':
+            for name, func in micro_scenarios(dataset['book_range']).items():
+                if only and name not in only:
+                    continue
+                if cold_cache:
+                    cache.clear()
+                results['scenarios'][name] = run_micro(name, func, requests_count, seed_value)
+                click.echo(f"{name:<24} {json.dumps(results['scenarios'][name])}")
+        else:
+            make_driver = TestClientDriver if mode == 'client' else lambda: HttpDriver(url)
+            in_process = mode == 'client' or server is not None
+            for scenario in SCENARIOS:
+                if only and scenario.name not in only:
+                    continue
+                if cold_cache:
+                    cache.clear()
+                results['scenarios'][scenario.name] = run_scenario(
+                    scenario, make_driver, requests_count, concurrency, seed_value, dataset, in_process)
+                click.echo(f"{scenario.name:<24} {json.dumps(results['scenarios'][scenario.name])}")
+    finally:
+        if server:
+            server.shutdown()
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if baseline:
+        with open(baseline, 'r', encoding='utf-8') as f:
+            baseline_results = json.load(f)
+        for field in ('mode', 'dialect', 'books', 'concurrency'):
+            if baseline_results['meta'].get(field) != results['meta'][field]:
+                click.echo(f"Warning: baseline {field} is {baseline_results['meta'].get(field)!r}, "
+                           f"this run has {results['meta'][field]!r}")
+        regressions = compare(results, baseline_results, tolerance)
+        if regressions:
+            raise click.ClickException(f"Regressions: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
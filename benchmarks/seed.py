@@ -0,0 +1,202 @@
+import json
+import random
+import time
+from datetime import date, timedelta
+
+import click
+from sqlalchemy import func, insert, text
+from werkzeug.security import generate_password_hash
+
+from db.database import engine, init_db, session_scope
+from db.migrations import upgrade
+from db.models import Book, Order, OrderItem, Review, User
+from services.analytics import backfill_sales_rollups
+from services.bestsellers import rebuild_sales_rollup
+from services.inventory import stock_missing_books
+from services.recommendations import rebuild_copurchases
+from services.reviews import recompute_ratings
+
+PASSWORD = 'benchmark'
+BATCH_SIZE = 5000
+ORDER_DAYS = 90
+
+WORDS = ('тайна', 'город', 'ночь', 'море', 'звезда', 'сад', 'путь', 'огонь', 'дом', 'ветер', 'тень', 'зима',
+         'лето', 'король', 'остров', 'письмо', 'мост', 'река', 'гора', 'время', 'сердце', 'камень', 'свет')
+AUTHORS = ('Анна Орлова', 'Иван Петров', 'Мария Соколова', 'Дмитрий Волков', 'Елена Морозова',
+           'Сергей Лебедев', 'Ольга Новикова', 'Павел Козлов', 'Татьяна Зайцева', 'Алексей Смирнов')
+
+
+def catalog_shapes():
+    with open('scripts/books.json', 'r', encoding='utf-8') as f:
+        books = json.load(f)
+    shapes = sorted({(book['category'], book['subcategory'], book['genre']) for book in books})
+    covers = sorted({book['cover'] for book in books})
+    return shapes, covers
+
+
+def next_id(session, model):
+    return (session.query(func.max(model.id)).scalar() or 0) + 1
+
+
+def insert_batches(model, rows):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            with session_scope() as session:
+                session.execute(insert(model), batch)
+            batch = []
+    if batch:
+        with session_scope() as session:
+            session.execute(insert(model), batch)
+
+
+def book_rows(rnd, first_id, count):
+    shapes, covers = catalog_shapes()
+    for book_id in range(first_id, first_id + count):
+        category, subcategory, genre = rnd.choice(shapes)
+        title = ' '.join(rnd.sample(WORDS, 3)).capitalize()
+        yield {
+            'id': book_id,
+            # Номер в названии гарантирует уникальность пары (title, author).
+            'title': f'{title} {book_id}',
+            'author': rnd.choice(AUTHORS),
+            'price': round(rnd.uniform(150, 3000), 2),
+            'genre': genre,
+            'cover': rnd.choice(covers),
+            'description': ' '.join(rnd.choices(WORDS, k=12)).capitalize() + '.',
+            'year': rnd.randint(1850, 2024),
+            'category': category,
+            'subcategory': subcategory
+        }
+
+
+def user_rows(first_id, count):
+    # Хэш пароля считается один раз: scrypt на каждого пользователя занял бы часы.
+    password_hash = generate_password_hash(PASSWORD)
+    for user_id in range(first_id, first_id + count):
+        yield {
+            'id': user_id,
+            'username': f'bench{user_id}',
+            'user_phone': f'+7999{user_id:07d}',
+            'email': f'bench{user_id}@example.com',
+            'password_hash': password_hash
+        }
+
+
+def order_rows(rnd, first_order_id, first_item_id, item_count, user_ids, book_ids, prices):
+    orders, items = [], []
+    order_id, item_id = first_order_id, first_item_id
+    today = date.today()
+    while item_id < first_item_id + item_count:
+        lines = rnd.sample(range(len(book_ids)), min(rnd.randint(1, 5), len(book_ids)))
+        total = 0
+        for index in lines:
+            count = rnd.randint(1, 3)
+            cost = count * prices[index]
+            items.append({'id': item_id, 'order_id': order_id, 'book_id': book_ids[index],
+                          'book_count': count, 'cost': cost})
+            total += cost
+            item_id += 1
+        day = today - timedelta(days=rnd.randint(0, ORDER_DAYS))
+        orders.append({
+            'id': order_id,
+            'user_id': rnd.choice(user_ids),
+            'date': day,
+            'status': 'Оформлен',
+            'total_amount': round(total, 2),
+            'address': 'г. Москва, ул. Тестовая, д. 1',
+            'payment_method': 'card',
+            'delivery_method': 'courier',
+            'customer_name': 'Тест Тестов',
+            'cash_on_delivery': False,
+            'delivery_date': (day + timedelta(days=3)).strftime('%d.%m.%Y')
+        })
+        order_id += 1
+        if len(items) >= BATCH_SIZE:
+            yield orders, items
+            orders, items = [], []
+    if orders:
+        yield orders, items
+
+
+def review_rows(rnd, first_id, count, user_ids, book_ids):
+    pairs = set()
+    while len(pairs) < min(count, len(user_ids) * len(book_ids)):
+        pairs.add((rnd.choice(user_ids), rnd.choice(book_ids)))
+    for review_id, (user_id, book_id) in enumerate(sorted(pairs), start=first_id):
+        yield {'id': review_id, 'user_id': user_id, 'book_id': book_id, 'rating': rnd.randint(1, 5),
+               'review': rnd.choice(('Отличная книга', 'Неплохо', 'Не понравилось', None))}
+
+
+# Явные id сдвигают значения в таблицах, но не последовательности PostgreSQL.
+def reset_sequences():
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as connection:
+        for table in ('books', 'users', 'orders', 'order_items', 'reviews'):
+            connection.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                                    f"coalesce(max(id), 1)) FROM {table}"))
+
+
+def seed(books, users, order_items, reviews, seed_value=42, progress=print):
+    rnd = random.Random(seed_value)
+    init_db()
+    upgrade(engine)
+
+    with session_scope() as session:
+        first_book, first_user = next_id(session, Book), next_id(session, User)
+        first_order, first_item = next_id(session, Order), next_id(session, OrderItem)
+        first_review = next_id(session, Review)
+
+    started = time.monotonic()
+    insert_batches(Book, book_rows(rnd, first_book, books))
+    progress(f'books: {books} ({time.monotonic() - started:.1f}s)')
+    insert_batches(User, user_rows(first_user, users))
+    progress(f'users: {users} ({time.monotonic() - started:.1f}s)')
+
+    with session_scope() as session:
+        catalog = session.query(Book.id, Book.price).order_by(Book.id).all()
+        user_ids = [user_id for user_id, in session.query(User.id).order_by(User.id)]
+    book_ids = [book_id for book_id, _ in catalog]
+    prices = [price for _, price in catalog]
+
+    if order_items and book_ids and user_ids:
+        for orders, items in order_rows(rnd, first_order, first_item, order_items, user_ids, book_ids, prices):
+            with session_scope() as session:
+                session.execute(insert(Order), orders)
+                session.execute(insert(OrderItem), items)
+        progress(f'order items: {order_items} ({time.monotonic() - started:.1f}s)')
+
+    if reviews and book_ids and user_ids:
+        insert_batches(Review, review_rows(rnd, first_review, reviews, user_ids, book_ids))
+        progress(f'reviews: {reviews} ({time.monotonic() - started:.1f}s)')
+
+    reset_sequences()
+    with session_scope() as session:
+        rebuild_sales_rollup(session)
+        recompute_ratings(session)
+        stock_missing_books(session)
+    rebuild_copurchases()
+    backfill_sales_rollups()
+    progress(f'done in {time.monotonic() - started:.1f}s')
+
+
+@click.command()
+@click.option('--books', default=100_000, show_default=True)
+@click.option('--users', default=50_000, show_default=True)
+@click.option('--order-items', default=1_000_000, show_default=True)
+@click.option('--reviews', default=100_000, show_default=True)
+@click.option('--seed', 'seed_value', default=42, show_default=True, help='Seed for reproducible data')
+@click.option('--append', is_flag=True, help='Allow seeding a database that already has books')
+def main(books, users, order_items, reviews, seed_value, append):
+    init_db()
+    with session_scope() as session:
+        existing = session.query(func.count(Book.id)).scalar()
+    if existing and not append:
+        raise click.ClickException(f'Database already has {existing} books, use --append to add more')
+    seed(books, users, order_items, reviews, seed_value, click.echo)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+import random
+import threading
+import time
+from collections import Counter
+from datetime import date
+from uuid import uuid4
+
+import click
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.exc import OperationalError
+
+from config import settings
+from db.database import engine, session_scope
+from db.models import Book, BookSalesDaily, BookStock, CartItem, StockReservation, User
+from services.analytics import update_sales_rollups
+from services.inventory import OutOfStockError, reserve_cart, set_stock, stock_levels
+from services.orders import place_order
+
+DETAILS = {
+    'address': 'г. Москва, ул. Тестовая, д. 1',
+    'payment_method': 'card',
+    'delivery_method': 'courier',
+    'customer_name': 'Тест Тестов',
+    'cash_on_delivery': False,
+    'delivery_date': date.today().strftime('%d.%m.%Y')
+}
+
+
+def fill_cart(user_id, cart):
+    with session_scope() as session:
+        session.execute(delete(CartItem).where(CartItem.user_id == user_id))
+        session.execute(insert(CartItem), [{'user_id': user_id, 'book_id': book_id, 'count': count}
+                                           for book_id, count in cart.items()])
+
+
+def book_sales(book_ids):
+    with session_scope() as session:
+        return dict(session.execute(
+            select(BookSalesDaily.book_id, func.sum(BookSalesDaily.sold))
+            .where(BookSalesDaily.book_id.in_(book_ids)).group_by(BookSalesDaily.book_id)
+        ).all())
+
+
+# Распродажа: каждый поток — свой покупатель, корзины из нескольких общих книг
+# в случайном порядке, так что заказы пересекаются по строкам склада. Половина
+# покупателей сначала резервирует корзину, как кнопка «Перейти к оформлению».
+# Продано должно быть ровно столько, сколько было, без взаимоблокировок. Параллельно
+# работает rollup-sales: продажи по дням и совместные покупки пишутся им, а не заказами,
+# и после распродажи продажи по дням должны сойтись с проданным.
+def flash_sale(book_ids, user_ids, quantity, shards, attempts, cart_size, seed_value, rollup_interval):
+    with session_scope() as session:
+        for book_id in book_ids:
+            set_stock(session, book_id, quantity, shards)
+        session.execute(delete(StockReservation).where(StockReservation.book_id.in_(book_ids)))
+    update_sales_rollups(settle=False)
+    sales_before = book_sales(book_ids)
+
+    counts = Counter()
+    sold = Counter()
+    lock = threading.Lock()
+    remaining = iter(range(attempts))
+
+    def buyer(user_id, rnd):
+        while True:
+            with lock:
+                attempt = next(remaining, None)
+            if attempt is None:
+                return
+            cart = {book_id: rnd.randint(1, 2) for book_id in rnd.sample(book_ids, cart_size)}
+            fill_cart(user_id, cart)
+            try:
+                if attempt % 2:
+                    with session_scope() as session:
+                        reserve_cart(session, user_id)
+                with session_scope() as session:
+                    place_order(session, user_id, uuid4().hex, DETAILS)
+                outcome = 'orders'
+            except OutOfStockError:
+                outcome = 'rejected'
+            except OperationalError as error:
+                outcome = 'deadlocks' if 'deadlock' in str(error).lower() else 'errors'
+            with lock:
+                counts[outcome] += 1
+                if outcome == 'orders':
+                    sold.update(cart)
+
+    selling = threading.Event()
+    selling.set()
+
+    def rollups():
+        while selling.is_set():
+            try:
+                update_sales_rollups()
+                outcome = 'rollups'
+            except OperationalError as error:
+                outcome = 'deadlocks' if 'deadlock' in str(error).lower() else 'errors'
+            with lock:
+                counts[outcome] += 1
+            time.sleep(rollup_interval)
+
+    workers = [threading.Thread(target=buyer, args=(user_id, random.Random(seed_value + user_id)))
+               for user_id in user_ids]
+    roller = threading.Thread(target=rollups)
+    started = time.perf_counter()
+    roller.start()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    selling.clear()
+    roller.join()
+    # Все заказы зафиксированы: оставшиеся можно учесть, не дожидаясь следующего запуска.
+    update_sales_rollups(settle=False)
+    sales_after = book_sales(book_ids)
+
+    with session_scope() as session:
+        left = stock_levels(session, book_ids)
+        reserved = dict(session.execute(
+            select(StockReservation.book_id, func.sum(StockReservation.quantity))
+            .where(StockReservation.book_id.in_(book_ids)).group_by(StockReservation.book_id)
+        ).all())
+        negative = session.query(func.count()) \
+            .filter(BookStock.book_id.in_(book_ids), BookStock.quantity < 0).scalar()
+        session.execute(delete(StockReservation).where(StockReservation.user_id.in_(user_ids)))
+        session.execute(delete(CartItem).where(CartItem.user_id.in_(user_ids)))
+
+    lost = {book_id: quantity - sold[book_id] - left[book_id] - reserved.get(book_id, 0) for book_id in book_ids}
+    unrolled = {book_id: sold[book_id] - sales_after.get(book_id, 0) + sales_before.get(book_id, 0)
+                for book_id in book_ids}
+    return {
+        'orders': counts['orders'],
+        'rejected': counts['rejected'],
+        'deadlocks': counts['deadlocks'],
+        'errors': counts['errors'],
+        'sold': sum(sold.values()),
+        'left': sum(left.values()),
+        'lost': {book_id: amount for book_id, amount in lost.items() if amount},
+        'unrolled': {book_id: amount for book_id, amount in unrolled.items() if amount},
+        'rollups': counts['rollups'],
+        'negative_shards': negative,
+        'orders_per_second': round(attempts / elapsed, 1)
+    }
+
+
+# Число SQL-запросов одного place_order не должно зависеть от размера корзины.
+def queries_per_order(user_id, book_ids):
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    fill_cart(user_id, {book_id: 1 for book_id in book_ids})
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        with session_scope() as session:
+            place_order(session, user_id, uuid4().hex, DETAILS)
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return len(statements)
+
+
+@click.command()
+@click.option('--books', 'book_count', default=5, show_default=True, help='Hot books shared by all carts')
+@click.option('--quantity', default=200, show_default=True, help='Copies of each book on sale')
+@click.option('--attempts', default=2000, show_default=True, help='Orders to place')
+@click.option('--threads', default=16, show_default=True, help='Concurrent buyers, one user each')
+@click.option('--cart-size', default=3, show_default=True, help='Hot books in every cart')
+@click.option('--shards', 'shard_counts', multiple=True, type=int, help='Shard counts to compare [1, STOCK_SHARDS]')
+@click.option('--rollup-interval', default=0.5, show_default=True, help='Seconds between concurrent rollup-sales runs')
+@click.option('--seed', 'seed_value', default=42, show_default=True)
+def main(book_count, quantity, attempts, threads, cart_size, shard_counts, rollup_interval, seed_value):
+    with session_scope() as session:
+        book_ids = list(session.scalars(select(Book.id).order_by(Book.id).limit(book_count)))
+        user_ids = list(session.scalars(select(User.id).order_by(User.id).limit(threads)))
+    if len(book_ids) < book_count or len(user_ids) < threads:
+        raise click.ClickException('Seed the database first: python -m benchmarks.seed')
+    cart_size = min(cart_size, book_count)
+
+    failed = False
+    configured = settings.STOCK_SHARDS
+    for shards in shard_counts or sorted({1, configured}):
+        # Случайный шард быстрого пути выбирается из STOCK_SHARDS.
+        settings.STOCK_SHARDS = shards
+        try:
+            result = flash_sale(book_ids, user_ids, quantity, shards, attempts, cart_size, seed_value,
+                                rollup_interval)
+        finally:
+            settings.STOCK_SHARDS = configured
+        click.echo(f"shards {shards:<3} orders {result['orders']:>6} rejected {result['rejected']:>6} "
+                   f"deadlocks {result['deadlocks']:>3} errors {result['errors']:>4} "
+                   f"sold {result['sold']:>6} left {result['left']:>6} {result['orders_per_second']:>8.1f} orders/s "
+                   f"rollups {result['rollups']:>3}")
+        if result['lost'] or result['unrolled'] or result['negative_shards'] or result['deadlocks']:
+            failed = True
+
+    # Запас заново, чтобы оба заказа прошли быстрым путём.
+    with session_scope() as session:
+        for book_id in book_ids:
+            set_stock(session, book_id, quantity)
+    single, full = queries_per_order(user_ids[0], book_ids[:1]), queries_per_order(user_ids[0], book_ids)
+    click.echo(f'queries per order: {single} for 1 book, {full} for {len(book_ids)} books')
+    if single != full:
+        failed = True
+
+    if failed:
+        raise click.ClickException('Stock was oversold, lost or deadlocked, or sales were not rolled up')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from pydantic_settings import BaseSettings
 
 
@@ -5,7 +7,52 @@ class Settings(BaseSettings):
     DATABASE_URL: str
     SECRET_KEY: str
     APP_PORT: int
-    DEBUG: bool = True
+    DATABASE_REPLICA_URLS: str = ''
+    REPLICA_SELECTION: str = 'round_robin'
+    READ_YOUR_WRITES_SECONDS: float = 5
+    DEBUG: bool = False
+    APP_HOST: str = '127.0.0.1'
+    WORKERS: Optional[int] = None
+    THREADS: int = 8
+    REQUEST_QUEUE: int = 64
+    WARM_UP: bool = True
+    DB_POOL_SIZE: int = 5
+    DB_MAX_OVERFLOW: int = 10
+    DB_POOL_TIMEOUT: float = 30
+    DB_POOL_RECYCLE: int = 1800
+    DB_POOL_PRE_PING: bool = True
+    BOOK_CHANGES_POLL_SECONDS: float = 1
+    BOOK_CHANGES_KEEP: int = 10000
+    BOOK_CHANGES_MAX_IDS: int = 1000
+    BOOK_CHANGES_GAP_SECONDS: float = 60
+    CATALOG_PAGE_SIZE: int = 24
+    ORDERS_PAGE_SIZE: int = 20
+    BESTSELLERS_CACHE_TTL: int = 60
+    CACHE_BACKEND: str = 'memory'
+    CACHE_SQLITE_PATH: str = 'cache.sqlite3'
+    CACHE_MAX_ENTRIES: int = 2048
+    CACHE_TTL: int = 300
+    USER_CACHE_TTL: int = 300
+    COVERS_SOURCE_DIR: str = 'static/images/books'
+    COVERS_OUTPUT_DIR: str = 'static/covers'
+    USER_CACHE_MAX_ENTRIES: int = 10000
+    RECOMMENDATIONS_TOP_K: int = 12
+    RECOMMENDATIONS_CACHE_MAX_ENTRIES: int = 10000
+    RECOMMENDATIONS_CACHE_TTL: int = 3600
+    COPURCHASE_REBUILD_CHUNK: int = 10000
+    ROLLUP_CHUNK_SIZE: int = 5000
+    ADMIN_EMAILS: str = ''
+    METRICS_TOKEN: str = ''
+    EXPORT_BATCH_SIZE: int = 1000
+    STOCK_SHARDS: int = 8
+    INITIAL_STOCK: int = 100
+    RESERVATION_TTL: int = 900
+    PUBLIC_CACHE_MAX_AGE: int = 60
+    COMPRESS_MIN_SIZE: int = 1024
+    GZIP_LEVEL: int = 6
+    BROTLI_QUALITY: int = 5
+    SLOW_QUERY_MS: Optional[float] = None
+    N_PLUS_ONE_THRESHOLD: int = 10
 
     class Config:
         env_file = ".env"
@@ -0,0 +1,133 @@
+import time
+from collections import defaultdict
+
+from sqlalchemy import delete, event, func, insert, select
+from sqlalchemy.orm import Session, object_session
+
+from config import settings
+from db.models import Book, BookChange, User
+
+_listeners = defaultdict(list)
+book_changes = BookChange.__table__
+
+
+def on_changed(kind):
+    def register(callback):
+        _listeners[kind].append(callback)
+        return callback
+    return register
+
+
+def notify_changed(session, kind, ids):
+    session.info.setdefault('changed', defaultdict(set))[kind].update(ids)
+
+
+def on_books_changed(callback):
+    return on_changed('books')(callback)
+
+
+def notify_books_changed(session, book_ids):
+    notify_changed(session, 'books', book_ids)
+
+
+def track_changes(model, kind):
+    def track(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            notify_changed(session, kind, [target.id])
+
+    for event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(model, event_name, track)
+
+
+track_changes(Book, 'books')
+track_changes(User, 'users')
+
+
+# Изменённые книги попадают в журнал той же транзакцией, что и сами изменения.
+# Крупный пакет записывается одной строкой без id, журнал обрезается до BOOK_CHANGES_KEEP строк.
+@event.listens_for(Session, 'before_commit')
+def _journal_book_changes(session):
+    if session.info.get('readonly'):
+        return
+    session.flush()
+    book_ids = session.info.get('changed', {}).get('books')
+    if not book_ids:
+        return
+    if len(book_ids) > settings.BOOK_CHANGES_MAX_IDS:
+        rows = [{'book_id': None}]
+    else:
+        rows = [{'book_id': book_id} for book_id in book_ids]
+    session.execute(insert(book_changes), rows)
+    newest = select(func.max(book_changes.c.id)).scalar_subquery()
+    session.execute(delete(book_changes).where(book_changes.c.id <= newest - settings.BOOK_CHANGES_KEEP))
+
+
+# Чтение журнала для индексов в памяти процесса. Читать его нужно с основной базы.
+# На PostgreSQL id выдаётся до фиксации, поэтому транзакция с меньшим id может
+# зафиксироваться позже прочитанных строк: пропущенные id перечитываются ещё
+# BOOK_CHANGES_GAP_SECONDS (откаченные транзакции оставляют пропуски навсегда).
+class BookChangeFeed:
+
+    def __init__(self):
+        self.last_id = None
+        self.polled = 0
+        self.gaps = {}
+
+    def due(self):
+        return self.last_id is None or time.monotonic() - self.polled >= settings.BOOK_CHANGES_POLL_SECONDS
+
+    # Позиция запоминается до загрузки индекса: изменения, зафиксированные во время
+    # загрузки, будут прочитаны ещё раз, а повторное применение безвредно.
+    def reset(self, session):
+        self.last_id = session.scalar(select(func.max(book_changes.c.id))) or 0
+        self.polled = time.monotonic()
+        self.gaps = {}
+
+    # Возвращает id книг, изменённых после прошлого чтения, или None, если индекс нужно
+    # перестроить: было массовое изменение или журнал обрезан дальше прочитанной позиции.
+    def read(self, session):
+        now = self.polled = time.monotonic()
+        self.gaps = {gap: seen for gap, seen in self.gaps.items()
+                     if now - seen < settings.BOOK_CHANGES_GAP_SECONDS}
+        condition = book_changes.c.id > self.last_id
+        if self.gaps:
+            condition = condition | book_changes.c.id.in_(list(self.gaps))
+        rows = session.execute(
+            select(book_changes.c.id, book_changes.c.book_id).where(condition).order_by(book_changes.c.id)
+        ).all()
+        if not rows:
+            return set()
+
+        new = [row.id for row in rows if row.id > self.last_id]
+        truncated = bool(new) and new[0] > self.last_id + 1 and session.scalar(
+            select(book_changes.c.id).where(book_changes.c.id <= self.last_id).limit(1)) is None
+        for row in rows:
+            self.gaps.pop(row.id, None)
+        expected = self.last_id + 1
+        for row_id in new:
+            self.gaps.update(dict.fromkeys(range(expected, row_id), now))
+            expected = row_id + 1
+        self.last_id = max(self.last_id, rows[-1].id)
+        if truncated or len(self.gaps) > settings.BOOK_CHANGES_MAX_IDS:
+            self.gaps = {}
+            return None
+        if any(row.book_id is None for row in rows):
+            return None
+        return {row.book_id for row in rows}
+
+
+# Слушатели вызываются только после фиксации транзакции, чтобы кэши и индексы
+# не успели подхватить данные, которые затем будут откатаны.
+@event.listens_for(Session, 'after_commit')
+def _dispatch_changes(session):
+    changed = session.info.pop('changed', None)
+    if changed:
+        for kind, ids in changed.items():
+            for callback in _listeners[kind]:
+                callback(ids)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changes(session):
+    session.info.pop('changed', None)
@@ -1,29 +1,187 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, scoped_session
+import itertools
+import os
+import threading
+import time
+from contextvars import ContextVar
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session, sessionmaker, scoped_session
 from db.models import Base
+from db.pool_metrics import InstrumentedQueuePool, instrument_engine, pool_metrics
+from db.query_metrics import instrument_queries
 
 from contextlib import contextmanager
 
 from config import settings
 
-engine = create_engine(url=settings.DATABASE_URL)
+
+def engine_options(url):
+    options = {
+        'pool_pre_ping': settings.DB_POOL_PRE_PING,
+        'pool_recycle': settings.DB_POOL_RECYCLE,
+    }
+    url = make_url(url)
+    # SQLite в памяти живёт в одном соединении, очередь соединений ему не подходит.
+    if url.get_backend_name() != 'sqlite' or url.database not in (None, '', ':memory:'):
+        options.update({
+            'poolclass': InstrumentedQueuePool,
+            'pool_size': settings.DB_POOL_SIZE,
+            'max_overflow': settings.DB_MAX_OVERFLOW,
+            'pool_timeout': settings.DB_POOL_TIMEOUT,
+        })
+    return options
+
+
+engine = create_engine(url=settings.DATABASE_URL, **engine_options(settings.DATABASE_URL))
+instrument_engine(engine)
+instrument_queries(engine)
 SessionLocal = scoped_session(sessionmaker(bind=engine, autocommit=False, autoflush=False))
+ReadSession = sessionmaker(autocommit=False, autoflush=False)
+
+# Срок, до которого чтения текущего запроса идут в основную базу (read-your-writes).
+# Значение выставляет слой приложения, например из cookie пользователя.
+primary_until = ContextVar('primary_until', default=0.0)
+
+
+class ReadOnlySessionError(Exception):
+    pass
+
+
+class ReplicaRouter:
+
+    def __init__(self, engines, strategy='round_robin'):
+        self.engines = engines
+        self.strategy = strategy
+        self.lock = threading.Lock()
+        self.turn = itertools.count()
+        self.active = {id(replica): 0 for replica in engines}
+
+    # least_loaded выбирает реплику с наименьшим числом открытых читающих сессий
+    # этого процесса; при равенстве реплики чередуются по кругу.
+    def choose(self):
+        with self.lock:
+            start = next(self.turn) % len(self.engines)
+            candidates = self.engines[start:] + self.engines[:start]
+            if self.strategy == 'least_loaded':
+                replica = min(candidates, key=lambda candidate: self.active[id(candidate)])
+            else:
+                replica = candidates[0]
+            self.active[id(replica)] += 1
+            return replica
+
+    def release(self, replica):
+        with self.lock:
+            self.active[id(replica)] -= 1
+
+    def dispose(self, close=True):
+        for replica in self.engines:
+            replica.dispose(close=close)
+
+
+def create_replicas(urls):
+    replicas = []
+    for url in urls:
+        replica = create_engine(url=url, **engine_options(url))
+        instrument_queries(replica)
+        replicas.append(replica)
+    return replicas
+
+
+replica_urls = [url.strip() for url in settings.DATABASE_REPLICA_URLS.split(',') if url.strip()]
+replicas = ReplicaRouter(create_replicas(replica_urls), settings.REPLICA_SELECTION)
 
 
 def init_db():
     Base.metadata.create_all(bind=engine)
 
-    
 
+# Локальный режим проверки: реплики — файлы SQLite, в которые основная база копируется
+# backup API. Между синхронизациями реплика отстаёт, как при асинхронной репликации.
+def sync_sqlite_replicas():
+    if engine.dialect.name != 'sqlite' or any(replica.dialect.name != 'sqlite' for replica in replicas.engines):
+        raise ValueError('Replica sync is only supported for SQLite databases')
+    with engine.connect() as source:
+        for replica in replicas.engines:
+            with replica.connect() as target:
+                source.connection.driver_connection.backup(target.connection.driver_connection)
+    return len(replicas.engines)
 
+
+# Соединения, унаследованные от родительского процесса, нельзя использовать в дочернем:
+# пул заменяется новым, а сокеты родителя остаются открытыми для него самого.
+def dispose_pool_after_fork():
+    engine.dispose(close=False)
+    replicas.dispose(close=False)
+    pool_metrics.pool = engine.pool
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=dispose_pool_after_fork)
+
+
+def note_write():
+    primary_until.set(time.time() + settings.READ_YOUR_WRITES_SECONDS)
+
+
+def read_engine():
+    if not replicas.engines or primary_until.get() > time.time():
+        return None
+    return replicas.choose()
+
+
+# readonly=True отправляет сессию на реплику (если они настроены), кроме периода
+# read-your-writes после записи. Такая сессия ничего не фиксирует и не даёт записывать.
 @contextmanager
-def session_scope():
-    session = SessionLocal()
+def session_scope(readonly=False):
+    replica = read_engine() if readonly else None
+    if replica is None:
+        session = SessionLocal()
+    else:
+        session = ReadSession(bind=replica, info={'readonly': True})
     try:
         yield session
-        session.commit()
+        if replica is None:
+            session.commit()
+            if session.info.pop('wrote', False):
+                note_write()
+        else:
+            # Изменённые объекты не должны пропасть молча: flush поднимет ReadOnlySessionError.
+            session.flush()
+            session.rollback()
     except Exception:
         session.rollback()
         raise
     finally:
-        session.close()
\ No newline at end of file
+        session.info.pop('wrote', None)
+        session.close()
+        if replica is not None:
+            replicas.release(replica)
+
+
+# Производные структуры (поисковый и фасетный индексы) строятся только по основной
+# базе: отставшая реплика закрепила бы в них устаревшие строки.
+@contextmanager
+def primary_session(session):
+    if not session.info.get('readonly'):
+        yield session
+        return
+    with session_scope() as primary:
+        yield primary
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_writes(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        session = orm_execute_state.session
+        if session.info.get('readonly'):
+            raise ReadOnlySessionError('Write statement in a read-only session')
+        session.info['wrote'] = True
+
+
+@event.listens_for(Session, 'before_flush')
+def _track_flushes(session, flush_context, instances):
+    if session.info.get('readonly'):
+        raise ReadOnlySessionError('Flush in a read-only session')
+    if session.new or session.dirty or session.deleted:
+        session.info['wrote'] = True
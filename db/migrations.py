@@ -0,0 +1,232 @@
+import logging
+from datetime import datetime
+
+from sqlalchemy import func, inspect, text
+
+from db.database import session_scope
+from db.models import (Base, BookChange, BookCoPurchase, BookCoPurchaseStaging, BookStock, Order, RollupWatermark,
+                       SalesRollupDaily, SchemaMigration, StockReservation)
+
+logger = logging.getLogger(__name__)
+
+MIGRATIONS = []
+
+
+def migration(version, name):
+    def register(func):
+        MIGRATIONS.append((version, name, func))
+        return func
+    return register
+
+
+def create_index(engine, name, table, columns, unique=False, where=None):
+    # На PostgreSQL индекс строится CONCURRENTLY вне транзакции, чтобы не блокировать
+    # запись в заполненную таблицу. IF NOT EXISTS делает миграцию повторяемой.
+    concurrently = 'CONCURRENTLY ' if engine.dialect.name == 'postgresql' else ''
+    statement = (f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}IF NOT EXISTS {name} "
+                 f"ON {table} ({', '.join(columns)})")
+    if where:
+        statement += f' WHERE {where}'
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text(statement))
+
+
+@migration(1, 'create missing tables')
+def create_missing_tables(engine):
+    from services.bestsellers import rebuild_sales_rollup
+
+    existing_tables = set(inspect(engine).get_table_names())
+    Base.metadata.create_all(bind=engine)
+
+    if 'book_sales_daily' not in existing_tables:
+        with session_scope() as session:
+            rebuild_sales_rollup(session)
+
+
+@migration(2, 'hot path indexes')
+def add_hot_path_indexes(engine):
+    create_index(engine, 'ix_books_category_price', 'books', ['category', 'price', 'id'])
+    create_index(engine, 'ix_books_subcategory_price', 'books', ['subcategory', 'price', 'id'])
+    create_index(engine, 'ix_books_title_author', 'books', ['title', 'author'])
+    create_index(engine, 'ix_books_author', 'books', ['author'])
+    create_index(engine, 'ix_orders_user_id_date', 'orders', ['user_id', 'date'])
+    create_index(engine, 'ix_orders_date', 'orders', ['date'])
+    create_index(engine, 'ix_order_items_order_id', 'order_items', ['order_id'])
+    create_index(engine, 'ix_order_items_book_id', 'order_items', ['book_id'])
+
+
+@migration(3, 'search indexes')
+def add_search_indexes(engine):
+    from services.search import ensure_search_indexes
+
+    ensure_search_indexes(engine)
+
+
+def merge_duplicate_books(connection):
+    groups = connection.execute(text(
+        'SELECT min(id) AS keep_id, title, author FROM books GROUP BY title, author HAVING count(*) > 1'
+    )).all()
+    for keep_id, title, author in groups:
+        params = {'keep_id': keep_id, 'title': title, 'author': author}
+        duplicates = 'SELECT id FROM books WHERE title = :title AND author = :author AND id <> :keep_id'
+        logger.warning('Merging duplicated book "%s" (%s) into id %s', title, author, keep_id)
+
+        connection.execute(text(f'UPDATE order_items SET book_id = :keep_id WHERE book_id IN ({duplicates})'), params)
+        connection.execute(text(f'UPDATE reviews SET book_id = :keep_id WHERE book_id IN ({duplicates})'), params)
+        connection.execute(text(
+            f'UPDATE cart_items SET count = count + (SELECT sum(d.count) FROM cart_items d '
+            f'WHERE d.user_id = cart_items.user_id AND d.book_id IN ({duplicates})) '
+            f'WHERE book_id = :keep_id AND user_id IN (SELECT user_id FROM cart_items WHERE book_id IN ({duplicates}))'
+        ), params)
+        connection.execute(text(
+            f'DELETE FROM cart_items WHERE book_id IN ({duplicates}) '
+            f'AND user_id IN (SELECT user_id FROM cart_items WHERE book_id = :keep_id)'
+        ), params)
+        connection.execute(text(f'UPDATE cart_items SET book_id = :keep_id WHERE book_id IN ({duplicates})'), params)
+        connection.execute(text(f'DELETE FROM book_sales_daily WHERE book_id IN ({duplicates})'), params)
+        connection.execute(text(f'DELETE FROM books WHERE id IN ({duplicates})'), params)
+    return len(groups)
+
+
+@migration(4, 'unique book title and author')
+def add_book_unique_key(engine):
+    from services.bestsellers import rebuild_sales_rollup
+
+    # До уникального ключа импорт мог загрузить одну книгу дважды: дубликаты
+    # сливаются в запись с меньшим id вместе с корзинами, заказами и отзывами.
+    with engine.begin() as connection:
+        merged = merge_duplicate_books(connection)
+    if merged:
+        # Пересборка записывает watermark, таблица которого появилась позже.
+        Base.metadata.create_all(bind=engine, tables=[RollupWatermark.__table__])
+        with session_scope() as session:
+            rebuild_sales_rollup(session)
+
+    create_index(engine, 'uq_books_title_author', 'books', ['title', 'author'], unique=True)
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.execute(text('DROP INDEX IF EXISTS ix_books_title_author'))
+
+
+@migration(5, 'order idempotency key')
+def add_order_idempotency_key(engine):
+    columns = {column['name'] for column in inspect(engine).get_columns('orders')}
+    if 'idempotency_key' not in columns:
+        with engine.begin() as connection:
+            connection.execute(text('ALTER TABLE orders ADD COLUMN idempotency_key VARCHAR(64)'))
+    create_index(engine, 'uq_orders_user_idempotency_key', 'orders', ['user_id', 'idempotency_key'], unique=True)
+
+
+@migration(6, 'one review per user and book')
+def add_review_constraints(engine):
+    from services.reviews import recompute_ratings
+
+    create_index(engine, 'ix_reviews_book_id', 'reviews', ['book_id'])
+
+    # Из повторных отзывов одного пользователя на книгу остаётся последний.
+    with engine.begin() as connection:
+        removed = connection.execute(text(
+            'DELETE FROM reviews WHERE parent_review_id IS NULL AND id NOT IN ('
+            'SELECT max(id) FROM reviews WHERE parent_review_id IS NULL GROUP BY user_id, book_id)'
+        )).rowcount
+    if removed:
+        logger.warning('Removed %s duplicated reviews', removed)
+        # Пересчёт рейтингов пишет в журнал изменений книг, который появился позже.
+        Base.metadata.create_all(bind=engine, tables=[BookChange.__table__])
+        with session_scope() as session:
+            recompute_ratings(session)
+
+    create_index(engine, 'uq_reviews_user_book', 'reviews', ['user_id', 'book_id'], unique=True,
+                 where='parent_review_id IS NULL')
+
+
+@migration(7, 'co-purchase matrix')
+def add_copurchase_matrix(engine):
+    from services.recommendations import rebuild_copurchases
+
+    Base.metadata.create_all(bind=engine, tables=[BookCoPurchase.__table__, BookCoPurchaseStaging.__table__,
+                                                  RollupWatermark.__table__])
+    rebuild_copurchases()
+
+
+@migration(8, 'sales rollups')
+def add_sales_rollups(engine):
+    from services.analytics import backfill_sales_rollups
+
+    Base.metadata.create_all(bind=engine, tables=[SalesRollupDaily.__table__, RollupWatermark.__table__])
+    backfill_sales_rollups()
+
+
+@migration(9, 'sharded stock and reservations')
+def add_stock(engine):
+    from services.inventory import stock_missing_books
+
+    Base.metadata.create_all(bind=engine, tables=[BookStock.__table__, StockReservation.__table__])
+    with session_scope() as session:
+        stock_missing_books(session)
+
+
+@migration(10, 'co-purchase rebuild staging table')
+def add_copurchase_staging(engine):
+    Base.metadata.create_all(bind=engine, tables=[BookCoPurchaseStaging.__table__])
+
+
+@migration(11, 'book change journal')
+def add_book_changes(engine):
+    Base.metadata.create_all(bind=engine, tables=[BookChange.__table__])
+
+
+# Продажи по дням и совместные покупки раньше обновлялись при оформлении заказа, поэтому
+# уже учитывают все заказы. Таблицы, пересобранные раньше в этом же обновлении, уже
+# получили watermark и не трогаются.
+@migration(12, 'order rollup watermarks')
+def add_order_rollup_watermarks(engine):
+    with session_scope() as session:
+        last_id = session.query(func.max(Order.id)).scalar() or 0
+        for name in ('book_sales', 'copurchases'):
+            if session.get(RollupWatermark, name) is None:
+                session.add(RollupWatermark(name=name, last_id=last_id, seen_id=last_id))
+
+
+def applied_versions(engine):
+    SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+    with session_scope() as session:
+        return {version for version, in session.query(SchemaMigration.version)}
+
+
+def upgrade(engine):
+    applied = applied_versions(engine)
+    for version, name, func in sorted(MIGRATIONS, key=lambda item: item[0]):
+        if version in applied:
+            continue
+        logger.info('Applying migration %s: %s', version, name)
+        func(engine)
+        with session_scope() as session:
+            session.add(SchemaMigration(version=version, name=name, applied_at=datetime.now()))
+
+
+def check_indexes(engine):
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+
+    missing = []
+    for table in Base.metadata.sorted_tables:
+        if table.name not in existing_tables:
+            missing.extend(index.name for index in table.indexes)
+            continue
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        missing.extend(index.name for index in table.indexes if index.name not in existing)
+    for name in missing:
+        logger.warning('Missing index %s, run "flask --app appSB db-upgrade"', name)
+
+    unused = []
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            unused = [row.indexrelname for row in connection.execute(text(
+                "SELECT s.indexrelname FROM pg_stat_user_indexes s "
+                "JOIN pg_index i ON i.indexrelid = s.indexrelid "
+                "WHERE s.idx_scan = 0 AND NOT i.indisunique AND NOT i.indisprimary"
+            ))]
+    for name in unused:
+        logger.info('Index %s has not been used since statistics were reset', name)
+
+    return missing, unused
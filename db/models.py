@@ -1,6 +1,6 @@
 from flask_login import UserMixin
 
-from sqlalchemy import Boolean, Column, Integer, String, Float, ForeignKey, Date, JSON
+from sqlalchemy import Boolean, Column, Integer, String, Float, ForeignKey, Date, DateTime, Index, JSON
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -41,6 +41,14 @@ class Book(Base):
     in_cart = relationship('CartItem', back_populates='book')
     in_order_item = relationship('OrderItem', back_populates='book')
     in_review = relationship('Review', back_populates='book')
+    sales = relationship('BookSalesDaily', back_populates='book')
+
+    __table_args__ = (
+        Index('ix_books_category_price', 'category', 'price', 'id'),
+        Index('ix_books_subcategory_price', 'subcategory', 'price', 'id'),
+        Index('uq_books_title_author', 'title', 'author', unique=True),
+        Index('ix_books_author', 'author'),
+    )
 
 
 class CartItem(Base):
@@ -70,10 +78,17 @@ class Order(Base):
     customer_name = Column(String(100), nullable=False)
     cash_on_delivery = Column(Boolean, default=False)
     delivery_date = Column(String(20), nullable=False)
+    idempotency_key = Column(String(64))
 
     bayer = relationship('User', back_populates='orders')
     item = relationship('OrderItem', back_populates='order')
 
+    __table_args__ = (
+        Index('ix_orders_user_id_date', 'user_id', 'date'),
+        Index('ix_orders_date', 'date'),
+        Index('uq_orders_user_idempotency_key', 'user_id', 'idempotency_key', unique=True),
+    )
+
 
 class OrderItem(Base):
 
@@ -88,6 +103,11 @@ class OrderItem(Base):
     book = relationship('Book', back_populates='in_order_item')
     order = relationship('Order', back_populates='item')
 
+    __table_args__ = (
+        Index('ix_order_items_order_id', 'order_id'),
+        Index('ix_order_items_book_id', 'book_id'),
+    )
+
 
 class Review(Base):
 
@@ -102,3 +122,119 @@ class Review(Base):
 
     user = relationship('User', back_populates='review')
     book = relationship('Book', back_populates='in_review')
+
+    __table_args__ = (
+        Index('ix_reviews_book_id', 'book_id'),
+        Index('uq_reviews_user_book', 'user_id', 'book_id', unique=True,
+              postgresql_where=parent_review_id.is_(None), sqlite_where=parent_review_id.is_(None)),
+    )
+
+
+class BookSalesDaily(Base):
+
+    __tablename__ = 'book_sales_daily'
+
+    day = Column(Date, primary_key=True)
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    sold = Column(Integer, nullable=False, default=0)
+
+    book = relationship('Book', back_populates='sales')
+
+
+# Сколько заказов содержали обе книги. Пара хранится в обе стороны, чтобы соседи
+# книги читались одним проходом по индексу.
+class BookCoPurchase(Base):
+
+    __tablename__ = 'book_copurchases'
+
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    other_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    orders = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = (
+        Index('ix_book_copurchases_top', 'book_id', 'orders', 'other_id'),
+    )
+
+
+# Пересборка матрицы пишет сюда и подменяет book_copurchases одной транзакцией,
+# чтобы рекомендации не пустели на время пересборки.
+class BookCoPurchaseStaging(Base):
+
+    __tablename__ = 'book_copurchases_staging'
+
+    book_id = Column(Integer, primary_key=True)
+    other_id = Column(Integer, primary_key=True)
+    orders = Column(Integer, nullable=False, default=0)
+
+
+# Остаток книги разбит на несколько строк-шардов: параллельные покупки одной книги
+# списывают разные строки и не ждут блокировку одной. Остаток книги — сумма шардов.
+class BookStock(Base):
+
+    __tablename__ = 'book_stock'
+
+    book_id = Column(Integer, ForeignKey('books.id'), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    quantity = Column(Integer, nullable=False, default=0)
+
+
+# Книги, уже списанные с остатка под оформление заказа. Истёкшая резервация
+# возвращает количество на склад.
+class StockReservation(Base):
+
+    __tablename__ = 'stock_reservations'
+
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    book_id = Column(Integer, ForeignKey('books.id'), nullable=False)
+    quantity = Column(Integer, nullable=False)
+    expires_at = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('ix_stock_reservations_user_book', 'user_id', 'book_id'),
+        Index('ix_stock_reservations_expires_at', 'expires_at'),
+    )
+
+
+# Продажи за день в разрезе измерения: dimension — 'total', 'genre', 'category',
+# 'payment_method' или 'delivery_method', value — значение измерения ('' для 'total').
+class SalesRollupDaily(Base):
+
+    __tablename__ = 'sales_rollup_daily'
+
+    dimension = Column(String(30), primary_key=True)
+    day = Column(Date, primary_key=True)
+    value = Column(String(100), primary_key=True)
+    orders = Column(Integer, nullable=False, default=0)
+    sold = Column(Integer, nullable=False, default=0)
+    revenue = Column(Float, nullable=False, default=0)
+
+
+class RollupWatermark(Base):
+
+    __tablename__ = 'rollup_watermarks'
+
+    name = Column(String(50), primary_key=True)
+    last_id = Column(Integer, nullable=False, default=0)
+    seen_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+
+# Журнал изменённых книг: по нему индексы в памяти каждого процесса (фасеты, поиск)
+# точечно подхватывают изменения других воркеров и CLI-команд. book_id NULL означает
+# массовое изменение, после которого индекс перестраивается целиком.
+class BookChange(Base):
+
+    __tablename__ = 'book_changes'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    book_id = Column(Integer)
+
+
+class SchemaMigration(Base):
+
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    name = Column(String(100), nullable=False)
+    applied_at = Column(DateTime, nullable=False)
@@ -0,0 +1,108 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+
+class PoolMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = None
+        self.connects = 0
+        self.checkouts = 0
+        self.checkins = 0
+        self.invalidations = 0
+        self.soft_invalidations = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_seconds_total = 0.0
+        self.wait_seconds_max = 0.0
+        self.max_overflow_used = 0
+
+    def increment(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.waits += 1
+            self.wait_seconds_total += seconds
+            self.wait_seconds_max = max(self.wait_seconds_max, seconds)
+
+    def record_overflow(self, pool):
+        with self.lock:
+            self.max_overflow_used = max(self.max_overflow_used, pool.overflow())
+
+    def snapshot(self):
+        with self.lock:
+            data = {
+                'connects': self.connects,
+                'checkouts': self.checkouts,
+                'checkins': self.checkins,
+                'invalidations': self.invalidations,
+                'soft_invalidations': self.soft_invalidations,
+                'timeouts': self.timeouts,
+                'waits': self.waits,
+                'wait_seconds_total': self.wait_seconds_total,
+                'wait_seconds_max': self.wait_seconds_max,
+                'wait_seconds_avg': self.wait_seconds_total / self.waits if self.waits else 0.0,
+                'max_overflow_used': self.max_overflow_used,
+            }
+        if isinstance(self.pool, QueuePool):
+            data.update({
+                'size': self.pool.size(),
+                'checked_out': self.pool.checkedout(),
+                'checked_in': self.pool.checkedin(),
+                'overflow': self.pool.overflow(),
+            })
+        return data
+
+
+pool_metrics = PoolMetrics()
+
+
+# В SQLAlchemy нет события «начали ждать соединение», поэтому время ожидания
+# измеряется вокруг получения соединения из очереди пула. Ожиданием считается только
+# выдача при исчерпанном пуле: нет свободных соединений и переполнение выбрано до
+# max_overflow. Остальные выдачи не ждут и учитываются только в checkouts.
+class InstrumentedQueuePool(QueuePool):
+
+    def _do_get(self):
+        exhausted = not self.checkedin() and -1 < self._max_overflow <= self.overflow()
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            pool_metrics.increment('timeouts')
+            raise
+        finally:
+            if exhausted:
+                pool_metrics.record_wait(time.perf_counter() - started)
+            pool_metrics.record_overflow(self)
+
+
+def instrument_engine(engine):
+    pool_metrics.pool = engine.pool
+
+    @event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        pool_metrics.increment('connects')
+
+    @event.listens_for(engine, 'checkout')
+    def on_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_metrics.increment('checkouts')
+
+    @event.listens_for(engine, 'checkin')
+    def on_checkin(dbapi_connection, connection_record):
+        pool_metrics.increment('checkins')
+
+    @event.listens_for(engine, 'invalidate')
+    def on_invalidate(dbapi_connection, connection_record, exception):
+        pool_metrics.increment('invalidations')
+
+    @event.listens_for(engine, 'soft_invalidate')
+    def on_soft_invalidate(dbapi_connection, connection_record, exception):
+        pool_metrics.increment('soft_invalidations')
@@ -0,0 +1,106 @@
+import logging
+import re
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+
+from sqlalchemy import event
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+WHITESPACE = re.compile(r'\s+')
+
+
+class RequestQueries:
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = Counter()
+
+    def repeated(self):
+        return [(statement, count) for statement, count in self.statements.items()
+                if count >= settings.N_PLUS_ONE_THRESHOLD]
+
+
+class QueryTotals:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queries = 0
+        self.seconds = 0.0
+        self.slow = 0
+
+    def add(self, seconds, slow):
+        with self.lock:
+            self.queries += 1
+            self.seconds += seconds
+            self.slow += slow
+
+
+query_totals = QueryTotals()
+current_queries = ContextVar('current_queries', default=None)
+
+
+def start_request():
+    queries = RequestQueries()
+    current_queries.set(queries)
+    return queries
+
+
+def finish_request():
+    queries = current_queries.get()
+    current_queries.set(None)
+    return queries
+
+
+def short_statement(statement, limit=300):
+    statement = WHITESPACE.sub(' ', statement).strip()
+    return statement if len(statement) <= limit else statement[:limit] + '...'
+
+
+# В лог попадают не значения параметров (там могут быть персональные данные),
+# а только их типы и размеры.
+def parameters_shape(parameters):
+    if isinstance(parameters, dict):
+        return {name: parameters_shape(value) for name, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        if len(parameters) > 3:
+            return f'{type(parameters).__name__}[{len(parameters)}] of {parameters_shape(parameters[0])}'
+        return [parameters_shape(value) for value in parameters]
+    if isinstance(parameters, (str, bytes)):
+        return f'{type(parameters).__name__}({len(parameters)})'
+    return type(parameters).__name__
+
+
+def instrument_queries(engine):
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+        slow = settings.SLOW_QUERY_MS is not None and seconds * 1000 >= settings.SLOW_QUERY_MS
+        query_totals.add(seconds, slow)
+
+        queries = current_queries.get()
+        if queries is not None:
+            queries.count += 1
+            queries.seconds += seconds
+            queries.statements[statement] += 1
+
+        if slow:
+            logger.warning('Slow query (%.1f ms): %s; parameters: %s', seconds * 1000,
+                           short_statement(statement), parameters_shape(parameters))
+
+    # Если запрос упал, after_cursor_execute не вызывается: метку времени нужно снять.
+    @event.listens_for(engine, 'handle_error')
+    def handle_error(exception_context):
+        connection = exception_context.connection
+        if connection is not None and connection.info.get('query_started'):
+            connection.info['query_started'].pop()
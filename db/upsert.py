@@ -0,0 +1,8 @@
+from sqlalchemy.dialects import postgresql, sqlite
+
+
+def insert_for(bind, table):
+    # ON CONFLICT есть и в PostgreSQL, и в SQLite, но конструкции у диалектов свои.
+    if bind.dialect.name == 'postgresql':
+        return postgresql.insert(table)
+    return sqlite.insert(table)
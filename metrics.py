@@ -0,0 +1,165 @@
+import bisect
+import logging
+import threading
+import time
+
+from flask import g, request, request_finished, request_started, request_tearing_down
+
+from db.pool_metrics import pool_metrics
+from db.query_metrics import finish_request, query_totals, short_statement, start_request
+from services.cache import cache
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class CounterMetric:
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class HistogramMetric:
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.series = {}
+
+    # Для каждой серии хранятся счётчики по корзинам (без накопления), сумма и количество;
+    # накопленные значения, как того требует формат Prometheus, считаются при выдаче.
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.description}', f'# TYPE {self.name} histogram']
+        bucket_labels = self.labels + ('le',)
+        with self.lock:
+            for label_values, (counts, total, count) in sorted(self.series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    labels = format_labels(bucket_labels, label_values + (bound,))
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = format_labels(self.labels, label_values)
+                lines.append(f'{self.name}_sum{labels} {total}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+def gauge_lines(name, description, value, kind='gauge'):
+    return [f'# HELP {name} {description}', f'# TYPE {name} {kind}', f'{name} {value}']
+
+
+def counter_lines(name, description, value):
+    return gauge_lines(name, description, value, 'counter')
+
+
+# Монотонные счётчики пула; остальные значения снимка — текущее состояние или максимум.
+POOL_COUNTERS = ('connects', 'checkouts', 'checkins', 'invalidations', 'soft_invalidations', 'timeouts', 'waits',
+                 'wait_seconds_total')
+
+
+request_latency = HistogramMetric('http_request_duration_seconds', 'Request latency by endpoint',
+                                  ('endpoint', 'method'))
+requests_total = CounterMetric('http_requests_total', 'Requests by endpoint and status',
+                               ('endpoint', 'method', 'status'))
+request_queries = HistogramMetric('db_queries_per_request', 'SQL statements executed per request',
+                                  ('endpoint',), QUERY_COUNT_BUCKETS)
+request_db_time = HistogramMetric('db_time_per_request_seconds', 'Time spent in SQL per request',
+                                  ('endpoint',))
+repeated_statements = CounterMetric('db_repeated_statements_total',
+                                     'Requests that ran the same statement many times (N+1)', ('endpoint',))
+
+REQUEST_METRICS = (request_latency, requests_total, request_queries, request_db_time, repeated_statements)
+
+
+def on_request_started(sender, **extra):
+    g.metrics_started = time.perf_counter()
+    start_request()
+
+
+def on_request_finished(sender, response, **extra):
+    g.metrics_status = response.status_code
+
+
+def on_request_tearing_down(sender, **extra):
+    started = g.pop('metrics_started', None)
+    queries = finish_request()
+    if started is None:
+        return
+    endpoint = request.endpoint or 'unmatched'
+    request_latency.observe(time.perf_counter() - started, endpoint, request.method)
+    requests_total.inc(endpoint, request.method, g.pop('metrics_status', 500))
+    if queries is None:
+        return
+
+    request_queries.observe(queries.count, endpoint)
+    request_db_time.observe(queries.seconds, endpoint)
+    repeated = queries.repeated()
+    if repeated:
+        repeated_statements.inc(endpoint)
+        for statement, count in repeated:
+            logger.warning('Possible N+1 in %s: statement executed %s times: %s',
+                           endpoint, count, short_statement(statement))
+
+
+def render_metrics():
+    lines = []
+    for metric in REQUEST_METRICS:
+        lines.extend(metric.render())
+
+    lines.extend(counter_lines('db_queries_total', 'SQL statements executed by this process', query_totals.queries))
+    lines.extend(counter_lines('db_query_seconds_total', 'Time spent in SQL by this process', query_totals.seconds))
+    lines.extend(counter_lines('db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS', query_totals.slow))
+    for name, value in pool_metrics.snapshot().items():
+        description = f'Connection pool {name.replace("_", " ")}'
+        if name in POOL_COUNTERS:
+            name = name if name.endswith('_total') else f'{name}_total'
+            lines.extend(counter_lines(f'db_pool_{name}', description, value))
+        else:
+            lines.extend(gauge_lines(f'db_pool_{name}', description, value))
+    for name, value in cache.stats.as_dict().items():
+        lines.extend(counter_lines(f'cache_{name}_total', f'Cache {name}', value))
+    return '\n'.join(lines) + '\n'
+
+
+def init_metrics(app):
+    request_started.connect(on_request_started, app)
+    request_finished.connect(on_request_finished, app)
+    request_tearing_down.connect(on_request_tearing_down, app)
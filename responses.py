@@ -0,0 +1,131 @@
+import gzip
+import hashlib
+import os
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+from flask import session as f_session
+from flask_login import current_user
+
+from config import settings
+from services.cache import cache
+from services.catalog import book_changes_position
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/plain', 'text/css', 'text/csv', 'application/json', 'application/javascript',
+    'application/x-ndjson', 'image/svg+xml'
+}
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+
+
+# Версия шаблонов входит в ETag, чтобы после выкладки новой вёрстки клиенты не получали 304
+# на старую страницу. Считается по именам, размерам и mtime, поэтому одинакова во всех воркерах.
+def templates_version():
+    digest = hashlib.sha1()
+    for root, _, files in sorted(os.walk(TEMPLATES_DIR)):
+        for name in sorted(files):
+            stat = os.stat(os.path.join(root, name))
+            digest.update(f'{name}:{stat.st_size}:{stat.st_mtime_ns};'.encode())
+    return digest.hexdigest()[:8]
+
+
+TEMPLATES_VERSION = templates_version()
+
+
+def bestsellers_version():
+    return int(time.time() // settings.BESTSELLERS_CACHE_TTL)
+
+
+# ETag строится из версий данных (поколений пространств кэша и позиции журнала изменений
+# книг), а не из тела ответа, поэтому его можно сравнить с If-None-Match до обращения
+# к базе и рендера шаблона. Поколения живут в памяти воркера, а позиция журнала общая:
+# по ней видны и изменения из других процессов.
+def data_etag(namespaces, version):
+    # Страница с ожидающими flash-сообщениями отличается от закэшированной у клиента.
+    if '_flashes' in f_session:
+        return None
+    user = f'user:{current_user.id}' if current_user.is_authenticated else 'anonymous'
+    parts = [TEMPLATES_VERSION, request.full_path, user]
+    parts.extend(str(cache.generation(namespace)) for namespace in namespaces)
+    if 'books' in namespaces:
+        parts.append(str(book_changes_position()))
+    if version:
+        parts.append(str(version()))
+    return hashlib.sha1('|'.join(parts).encode()).hexdigest()[:20]
+
+
+def cache_policy(namespaces=('books',), version=None, max_age=None):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                return view(*args, **kwargs)
+            etag = data_etag(namespaces, version)
+            g.cache_policy = (etag, settings.PUBLIC_CACHE_MAX_AGE if max_age is None else max_age)
+            if etag and request.if_none_match.contains_weak(etag):
+                return current_app.response_class(status=304)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Анонимные страницы одинаковы для всех и могут храниться в общих кэшах; страницы
+# авторизованного пользователя содержат его имя и корзину, поэтому только private.
+def apply_cache_policy(response):
+    policy = g.get('cache_policy')
+    if policy and response.status_code in (200, 304):
+        etag, max_age = policy
+        if etag:
+            response.set_etag(etag, weak=True)
+        if current_user.is_authenticated:
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+        else:
+            response.cache_control.public = True
+            response.cache_control.max_age = max_age
+        response.vary.add('Cookie')
+    elif not response.headers.get('Cache-Control') and response.mimetype in ('text/html', 'application/json'):
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+
+
+def compress_response(response):
+    if (response.direct_passthrough or response.is_streamed or response.status_code not in (200, 201)
+            or 'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return
+    response.vary.add('Accept-Encoding')
+
+    encoding = request.accept_encodings.best_match(ENCODINGS)
+    if not encoding or (response.content_length or 0) < settings.COMPRESS_MIN_SIZE:
+        return
+
+    data = response.get_data()
+    if encoding == 'br':
+        data = brotli.compress(data, quality=settings.BROTLI_QUALITY)
+    else:
+        data = gzip.compress(data, compresslevel=settings.GZIP_LEVEL)
+    response.set_data(data)
+    response.headers['Content-Encoding'] = encoding
+
+    # Сжатое представление побайтно отличается от исходного: строгий ETag становится слабым.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+
+
+def finalize_response(response):
+    apply_cache_policy(response)
+    compress_response(response)
+    return response
+
+
+def init_responses(app):
+    app.after_request(finalize_response)
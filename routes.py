@@ -1,20 +1,57 @@
+import hashlib
+import hmac
+import json
+from functools import wraps
 from random import randint
+from urllib.parse import urlencode
+from uuid import uuid4
 from datetime import date, timedelta
 from flask import session as f_session
-from flask import Blueprint, flash, redirect, render_template, url_for, request
+from flask import Blueprint, Response, abort, flash, jsonify, make_response, redirect, render_template, send_from_directory, url_for, request
 from flask_login import login_required, login_user, logout_user, current_user
 from flask_wtf import FlaskForm
-from sqlalchemy import func
-from wtforms import TextAreaField, PasswordField, StringField, SelectField, BooleanField, SubmitField
+from wtforms import TextAreaField, PasswordField, StringField, SelectField, BooleanField, SubmitField, HiddenField
 from wtforms.validators import Optional, Email, EqualTo, InputRequired, Length, Regexp, DataRequired
 from werkzeug.security import generate_password_hash, check_password_hash
 
-from db.database import session_scope
-from db.models import User, Order, OrderItem, Book, CartItem, Review
+from config import settings
+from db.database import primary_until, replicas, session_scope
+from db.models import User, Order, OrderItem
+from db.pool_metrics import pool_metrics
+from metrics import render_metrics
+from responses import bestsellers_version, cache_policy
+from services import images
+from services.bestsellers import top_books
+from services.cache import cache
+from services.cart import UnknownBookError, add_item, decrease_item, remove_item
+from services.catalog import get_book_cards
+from services.facets import (CATEGORY_LABELS, PRICE_BUCKETS, RATING_THRESHOLDS, SORT_KEYS, SUBCATEGORY_LABELS,
+                             facet_counts, facet_page)
+from services.inventory import OutOfStockError, reserve_cart
+from services.orders import EmptyCartError, fetch_orders_page, get_order, place_order
+from services.read_models import cart_lines
+from services.recommendations import recommended_books
+from services.reviews import DuplicateReviewError, add_review
+from services.search import search_books
+from services.users import forget_user, is_admin
 
 main_blueprint = Blueprint("main", __name__)
 
 
+# Срок read-your-writes хранится в сессии пользователя: после заказа или правки корзины
+# его запросы читают из основной базы в любом воркере, пока реплики не догонят запись.
+@main_blueprint.before_app_request
+def restore_primary_until():
+    primary_until.set(f_session.get('primary_until', 0.0) if replicas.engines else 0.0)
+
+
+@main_blueprint.after_app_request
+def remember_primary_until(response):
+    if replicas.engines and primary_until.get() > f_session.get('primary_until', 0.0):
+        f_session['primary_until'] = primary_until.get()
+    return response
+
+
 class RegistrationForm(FlaskForm):
     username = StringField(
         "Username", validators=[InputRequired(), Length(max=100, min=4)]
@@ -75,36 +112,16 @@ class OrderForm(FlaskForm):
         Length(min=2, max=100, message='ФИО должно быть от 2 до 100 символов')
     ])
 
+    idempotency_key = HiddenField()
+
     submit = SubmitField('Подтвердить и оформить заказ')
 
 
 @main_blueprint.route("/")
+@cache_policy(version=bestsellers_version)
 def home():
-    with session_scope() as session:
-        week_ago = date.today() - timedelta(days=7)
-        top_books = session.query(Book, func.sum(OrderItem.book_count).label('total_sold')) \
-            .join(OrderItem, Book.id == OrderItem.book_id) \
-            .join(Order, OrderItem.order_id == Order.id) \
-            .filter(Order.date >= week_ago) \
-            .group_by(Book.id) \
-            .order_by(func.sum(OrderItem.book_count).desc()) \
-            .limit(3).all()
-
-        books_data = []
-        for book, total_sold in top_books:
-            books_data.append({
-                'id': book.id,
-                'title': book.title,
-                'author': book.author,
-                'price': book.price,
-                'cover': book.cover,
-                'rating': book.rating,
-                'rating_count': book.rating_count,
-                'genre': book.genre,
-                'description': book.description,
-                'year': book.year,
-                'total_sold': total_sold
-            })
+    with session_scope(readonly=True) as session:
+        books_data = top_books(session)
     return render_template("home.html", top_books=books_data)
 
 
@@ -179,101 +196,203 @@ def login():
 
 @main_blueprint.route('/logout')
 def logout():
+    if current_user.is_authenticated:
+        forget_user(current_user.id)
     logout_user()
     return redirect(url_for('main.home'))
 
 
-@main_blueprint.route('/search', methods=['POST'])
+@main_blueprint.route('/search', methods=['GET', 'POST'])
+@cache_policy()
 def search():
-    book_title = request.form.get('search')
-    if not book_title:
-        return render_template('catalog.html')
-    with session_scope() as session:
-        book_data = [session.query(Book).filter_by(title=book_title).first().__dict__]
-    return render_template('catalog.html', books=book_data)
+    query = request.values.get('q') or request.values.get('search')
+    if not query:
+        return render_template('catalog.html', books_html='')
+    with session_scope(readonly=True) as session:
+        books_data, total = search_books(session, query, per_page=settings.CATALOG_PAGE_SIZE)
+    return render_template('catalog.html', books_html=render_template('_catalog_books.html', books=books_data),
+                           search_query=query, next_url=next_search_url(query, 1, total))
+
+
+@main_blueprint.route('/search/page')
+@cache_policy()
+def search_page():
+    query = request.args.get('q', '')
+    page = max(request.args.get('page', 1, type=int), 1)
+    with session_scope(readonly=True) as session:
+        books_data, total = search_books(session, query, page=page, per_page=settings.CATALOG_PAGE_SIZE)
+    return jsonify({
+        'html': render_template('_catalog_books.html', books=books_data),
+        'next_url': next_search_url(query, page, total)
+    })
+
+
+def next_search_url(query, page, total):
+    if page * settings.CATALOG_PAGE_SIZE >= total:
+        return None
+    return url_for('main.search_page', q=query, page=page + 1)
 
 
 @main_blueprint.route('/catalog')
+@cache_policy()
 def catalog():
-    category = request.args.get('category')
-    subcategory = request.args.get('subcategory')
+    filters = catalog_filters()
+    books_html, next_cursor = cached_catalog_page(filters)
+    with session_scope(readonly=True) as session:
+        counts = facet_counts(session, filters)
+    return render_template('catalog.html', books_html=books_html, filters=filters,
+                           filter_params=filter_params(filters), facets=counts, price_buckets=PRICE_BUCKETS,
+                           rating_thresholds=RATING_THRESHOLDS, category_labels=CATEGORY_LABELS,
+                           subcategory_labels=SUBCATEGORY_LABELS, next_url=next_page_url(filters, next_cursor))
+
+
+@main_blueprint.route('/catalog/page')
+@cache_policy()
+def catalog_page():
+    filters = catalog_filters()
+    books_html, next_cursor = cached_catalog_page(filters, request.args.get('cursor'))
+    return jsonify({
+        'html': books_html,
+        'next_url': next_page_url(filters, next_cursor)
+    })
+
+
+def catalog_filters():
+    sort = request.args.get('sort')
+    min_rating = request.args.get('min_rating', type=float)
+    return {
+        'category': sorted({value for value in request.args.getlist('category') if value}),
+        'subcategory': sorted({value for value in request.args.getlist('subcategory') if value}),
+        'genre': sorted({value for value in request.args.getlist('genre') if value}),
+        'price': sorted({value for value in request.args.getlist('price') if value in PRICE_BUCKETS}),
+        'year_from': request.args.get('year_from', type=int),
+        'year_to': request.args.get('year_to', type=int),
+        'min_rating': min_rating if min_rating in RATING_THRESHOLDS else None,
+        'sort': sort if sort in SORT_KEYS else None
+    }
+
+
+def filter_params(filters):
+    return {key: value for key, value in filters.items() if value not in (None, [])}
+
+
+# Фрагмент зависит только от фильтров, страницы и того, показывать ли кнопки корзины,
+# поэтому он общий для всех анонимных (и всех авторизованных) пользователей.
+def cached_catalog_page(filters, cursor=None):
+    key = cache.key('books', 'catalog', urlencode(sorted(filter_params(filters).items()), doseq=True),
+                    cursor, current_user.is_authenticated)
+
+    def render_page():
+        with session_scope(readonly=True) as session:
+            book_ids, next_cursor, _ = facet_page(session, filters, filters['sort'], cursor,
+                                                  settings.CATALOG_PAGE_SIZE)
+            books_data = get_book_cards(session, book_ids)
+        return render_template('_catalog_books.html', books=books_data), next_cursor
+
+    return cache.get_or_set(key, render_page)
+
+
+def next_page_url(filters, next_cursor):
+    if not next_cursor:
+        return None
+    return url_for('main.catalog_page', cursor=next_cursor, **filter_params(filters))
+
+
+@main_blueprint.route('/book/<int:book_id>')
+def book_detail(book_id):
+    detail = cached_book_detail(book_id)
+    if detail is None:
+        abort(404)
+    book, html, etag = detail
+
+    if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        response = jsonify(book._asdict())
+        response.set_etag(f'{etag}-json')
+    else:
+        response = make_response(html)
+        response.set_etag(etag)
+    # Браузер каждый раз переспрашивает сервер, но при неизменной книге получает 304 без тела.
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+    response.vary.add('Accept')
+    return response.make_conditional(request)
+
+
+# ETag считается по содержимому, поэтому сброс поколения 'books' из-за другой книги
+# не меняет его и не лишает клиента ответа 304.
+def cached_book_detail(book_id):
+    def render_detail():
+        with session_scope(readonly=True) as session:
+            books_data = get_book_cards(session, [book_id])
+            if not books_data:
+                return None
+            recommendations = recommended_books(session, [book_id])
+        html = render_template('_book_detail.html', book=books_data[0], recommendations=recommendations)
+        digest = hashlib.sha1(json.dumps(books_data[0]._asdict(), sort_keys=True).encode() + html.encode())
+        return books_data[0], html, digest.hexdigest()[:16]
+
+    return cache.get_or_set(cache.key('books', 'detail', book_id), render_detail)
+
+
+@main_blueprint.route('/covers/<path:filename>')
+def cover_file(filename):
+    response = send_from_directory(images.OUTPUT_DIR, filename, max_age=images.MAX_AGE)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+# Служебная статистика (ключи и счётчики кэша, пул, задержки по эндпоинтам) доступна
+# администраторам из ADMIN_EMAILS и сборщику метрик с заголовком
+# «Authorization: Bearer <METRICS_TOKEN>».
+def monitoring_access_required(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        token = settings.METRICS_TOKEN
+        authorization = request.headers.get('Authorization', '')
+        if not (token and hmac.compare_digest(authorization, f'Bearer {token}')) and not is_admin(current_user):
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
+
+@main_blueprint.route('/cache/stats')
+@monitoring_access_required
+def cache_stats():
+    return jsonify(cache.stats.as_dict())
+
+
+@main_blueprint.route('/db/pool/stats')
+@monitoring_access_required
+def pool_stats():
+    return jsonify(pool_metrics.snapshot())
+
 
-    with session_scope() as session:
-        if category:
-            books = session.query(Book).filter_by(category=category).all()
-        elif subcategory:
-            books = session.query(Book).filter_by(subcategory=subcategory).all()
-        else:
-            books = session.query(Book).all()
-
-        books_data = []
-        for book in books:
-            books_data.append({
-                'id': book.id,
-                'title': book.title,
-                'author': book.author,
-                'genre': book.genre,
-                'rating': book.rating,
-                'rating_count': book.rating_count,
-                'year': book.year,
-                'price': book.price,
-                'cover': book.cover,
-                'description': book.description
-            })
-
-        return render_template('catalog.html', books=books_data)
+@main_blueprint.route('/metrics')
+@monitoring_access_required
+def metrics():
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
 
 
 @main_blueprint.route('/cart', methods=['GET', 'POST'])
 @login_required
 def cart():
     with session_scope() as session:
-        cart_items_result = session.query(CartItem, Book).join(Book, CartItem.book_id == Book.id) \
-            .filter(CartItem.user_id == current_user.id).all()
-
-        cart_data = []
-        for cart_items, books in cart_items_result:
-            cart_data.append({
-                'cart_item': {
-                    'user_id': cart_items.user_id,
-                    'book_id': cart_items.book_id,
-                    'count': cart_items.count
-                },
-                'book': {
-                    'id': books.id,
-                    'title': books.title,
-                    'author': books.author,
-                    'price': books.price,
-                    'genre': books.genre,
-                    'cover': books.cover,
-                    'description': books.description,
-                    'rating': books.rating,
-                    'rating_count': books.rating_count,
-                    'year': books.year,
-                    'category': books.category,
-                    'subcategory': books.subcategory
-                }
-            })
-
-    return render_template('cart.html', cart_items=cart_data)
+        lines = cart_lines(session, current_user.id)
+        recommendations = recommended_books(session, [line.book.id for line in lines])
+
+    return render_template('cart.html', cart_items=lines, recommendations=recommendations)
 
 
 @main_blueprint.route('/add_to_cart', methods=['POST'])
 @login_required
 def add_to_cart():
-    book_id = request.form.get('book_id')
-    with session_scope() as session:
-        item = session.query(CartItem).filter(CartItem.book_id == book_id,
-                                              CartItem.user_id == current_user.id).first()
-        if not item:
-            new_item = CartItem(
-                user_id=current_user.id,
-                book_id=book_id,
-                count=1
-            )
-            session.add(new_item)
-        else:
-            item.count += 1
+    book_id = request.form.get('book_id', type=int)
+    try:
+        with session_scope() as session:
+            add_item(session, current_user.id, book_id)
+    except UnknownBookError:
+        abort(404)
 
     return redirect(request.referrer or url_for('main.catalog'))
 
@@ -281,11 +400,9 @@ def add_to_cart():
 @main_blueprint.route('/remove_from_cart', methods=['POST'])
 @login_required
 def remove_from_cart():
-    book_id = request.form.get('book_id')
+    book_id = request.form.get('book_id', type=int)
     with session_scope() as session:
-        item = session.query(CartItem).filter(CartItem.book_id == book_id,
-                                              CartItem.user_id == current_user.id).first()
-        session.delete(item)
+        remove_item(session, current_user.id, book_id)
 
     return redirect(request.referrer or url_for('main.cart'))
 
@@ -293,155 +410,125 @@ def remove_from_cart():
 @main_blueprint.route('/decrease_from_cart', methods=['POST'])
 @login_required
 def decrease_from_cart():
-    book_id = request.form.get('book_id')
+    book_id = request.form.get('book_id', type=int)
     with session_scope() as session:
-        item = session.query(CartItem).filter(CartItem.book_id == book_id,
-                                              CartItem.user_id == current_user.id).first()
-        if item.count > 1:
-            item.count -= 1
-        else:
-            session.delete(item)
+        decrease_item(session, current_user.id, book_id)
 
     return redirect(request.referrer or url_for('main.cart'))
 
 
-@main_blueprint.route('/making_an_order', methods=['GET', 'POST'])
+# Книги держатся за покупателем, пока он заполняет форму заказа. Резервация делается
+# кнопкой «Перейти к оформлению», а не при открытии страницы: GET не меняет склад.
+@main_blueprint.route('/making_an_order/reserve', methods=['POST'])
 @login_required
-def making_an_order():
+def reserve_checkout():
     with session_scope() as session:
-        cart_items_result = session.query(CartItem, Book).join(Book, CartItem.book_id == Book.id) \
-            .filter(CartItem.user_id == current_user.id).all()
-
-        if not cart_items_result:
-            flash('Ваша корзина пуста', 'warning')
-            return redirect(url_for('main.cart'))
+        unavailable = reserve_cart(session, current_user.id)
+    if unavailable:
+        flash(f'Недостаточно на складе: {book_titles(unavailable)}', 'warning')
+    return redirect(url_for('main.making_an_order'))
 
-        cart_data = []
-        total_price = 0
-        for cart_items, books in cart_items_result:
-            item_data = {
-                'cart_item': {
-                    'count': cart_items.count,
-                    'book_id': cart_items.book_id
-                },
-                'book': {
-                    'id': books.id,
-                    'title': books.title,
-                    'price': books.price,
-                    'author': books.author,
-                    'cover': books.cover
-                }
-            }
-            cart_data.append(item_data)
-            total_price += cart_items.count * books.price
 
+@main_blueprint.route('/making_an_order', methods=['GET', 'POST'])
+@login_required
+def making_an_order():
     delivery_date = date.today() + timedelta(days=3)
     formatted_delivery_date = delivery_date.strftime('%d.%m.%Y')
 
     form = OrderForm()
 
     if form.validate_on_submit():
-        with session_scope() as session:
-            delivery_address = form.address.data if form.delivery_method.data != 'pickup' else 'Самовывоз'
-            new_order = Order(
-                user_id=current_user.id,
-                date=date.today(),
-                status='Оформлен',
-                total_amount=total_price,
-                address=delivery_address,
-                payment_method=form.payment_method.data,
-                delivery_method=form.delivery_method.data,
-                customer_name=form.full_name.data,
-                cash_on_delivery=form.cash_on_delivery.data,
-                delivery_date=formatted_delivery_date
-            )
-            session.add(new_order)
-            session.flush()
-
-            for item in cart_data:
-                order_item = OrderItem(
-                    order_id=new_order.id,
-                    book_id=item['book']['id'],
-                    book_count=item['cart_item']['count'],
-                    cost=item['cart_item']['count'] * item['book']['price']
-                )
-                session.add(order_item)
-
-            session.query(CartItem).filter(CartItem.user_id == current_user.id).delete()
+        delivery_address = form.address.data if form.delivery_method.data != 'pickup' else 'Самовывоз'
+        details = {
+            'address': delivery_address,
+            'payment_method': form.payment_method.data,
+            'delivery_method': form.delivery_method.data,
+            'customer_name': form.full_name.data,
+            'cash_on_delivery': form.cash_on_delivery.data,
+            'delivery_date': formatted_delivery_date
+        }
+        try:
+            with session_scope() as session:
+                place_order(session, current_user.id, form.idempotency_key.data or uuid4().hex, details)
+        except EmptyCartError:
+            flash('Ваша корзина пуста', 'warning')
+            return redirect(url_for('main.cart'))
+        except OutOfStockError as error:
+            flash(f'Недостаточно на складе: {book_titles(error.book_ids)}', 'danger')
+            return redirect(url_for('main.cart'))
 
         flash('Заказ успешно оформлен!', 'success')
         return redirect(url_for('main.orders'))
 
+    with session_scope() as session:
+        lines = cart_lines(session, current_user.id)
+        if not lines:
+            flash('Ваша корзина пуста', 'warning')
+            return redirect(url_for('main.cart'))
+
+    total_price = sum(line.count * line.book.price for line in lines)
+    if not form.idempotency_key.data:
+        form.idempotency_key.data = uuid4().hex
+
     return render_template('making_an_order.html',
                            form=form,
                            total_price=total_price,
                            delivery_date=formatted_delivery_date,
-                           cart_items=cart_data)
+                           cart_items=lines)
+
+
+def book_titles(book_ids):
+    with session_scope(readonly=True) as session:
+        books_data = get_book_cards(session, sorted(book_ids))
+    return ', '.join(f'«{book.title}»' for book in books_data)
 
 
 @main_blueprint.route('/orders', methods=['GET'])
 @login_required
 def orders():
-    with session_scope() as session:
-        orders = session.query(Order, func.sum(OrderItem.book_count)).join(OrderItem, Order.id == OrderItem.order_id)\
-            .filter(Order.user_id == current_user.id)\
-            .group_by(Order.id).all()
-        orders_data = []
-        for order, items_sum in orders:
-            orders_data.append({
-                'id': order.id,
-                'date': order.delivery_date,
-                'status': order.status,
-                'total_amount': order.total_amount,
-                'total_books': items_sum
-            })
-        return render_template('orders.html', orders_data=orders_data)
+    with session_scope(readonly=True) as session:
+        orders_data, next_cursor = fetch_orders_page(session, current_user.id, limit=settings.ORDERS_PAGE_SIZE)
+    return render_template('orders.html', orders_data=orders_data,
+                           next_url=url_for('main.orders_page', cursor=next_cursor) if next_cursor else None)
+
+
+@main_blueprint.route('/orders/page', methods=['GET'])
+@login_required
+def orders_page():
+    with session_scope(readonly=True) as session:
+        orders_data, next_cursor = fetch_orders_page(session, current_user.id, request.args.get('cursor'),
+                                                     limit=settings.ORDERS_PAGE_SIZE)
+    return jsonify({
+        'html': render_template('_orders_rows.html', orders_data=orders_data),
+        'next_url': url_for('main.orders_page', cursor=next_cursor) if next_cursor else None
+    })
 
 
 @main_blueprint.route('/order_items', methods=['POST'])
 @login_required
 def order_items():
-    order_id = request.form.get('order_id')
-    with session_scope() as session:
-        books = session.query(Book).join(OrderItem, OrderItem.book_id == Book.id) \
-            .filter(OrderItem.order_id == order_id).all()
-        books_data = []
-        for book in books:
-            books_data.append({
-                'id': book.id,
-                'title': book.title,
-                'author': book.author,
-                'cover': book.cover,
-                'rating': book.rating,
-                'rating_count': book.rating_count,
-                'genre': book.genre,
-                'description': book.description,
-                'year': book.year
-            })
-        return render_template('order_items.html', books_data=books_data)
+    order_id = request.form.get('order_id', type=int)
+    with session_scope(readonly=True) as session:
+        order = get_order(session, current_user.id, order_id)
+    if not order:
+        abort(404)
+    return render_template('order_items.html', books_data=[item['book'] for item in order['items']])
 
 
 @main_blueprint.route('/submit_review', methods=['POST'])
 @login_required
 def submit_review():
-    book_id = request.form.get('book_id')
-    rating = request.form.get('rating')
+    book_id = request.form.get('book_id', type=int)
+    rating = request.form.get('rating', type=int)
     review_text = request.form.get('review_text', '')
-    with session_scope() as session:
-        new_review = Review(
-            review=review_text,
-            user_id=current_user.id,
-            book_id=book_id,
-            rating=rating
-        )
-        session.add(new_review)
-
-        book = session.query(Book).filter_by(id=book_id).first()
-        if not book.rating:
-            book.rating = int(rating)
-            book.rating_count = 1
-        else:
-            book.rating = (book.rating*book.rating_count + int(rating)) / (book.rating_count + 1)
-            book.rating_count += 1
+    if not book_id or rating not in range(1, 6):
+        flash('Выберите оценку от 1 до 5', 'danger')
+        return redirect(url_for('main.orders'))
+
+    try:
+        with session_scope() as session:
+            add_review(session, current_user.id, book_id, rating, review_text)
+    except DuplicateReviewError:
+        flash('Вы уже оставили отзыв на эту книгу', 'warning')
 
     return redirect(url_for('main.orders'))
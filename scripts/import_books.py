@@ -0,0 +1,122 @@
+import csv
+import json
+import time
+from itertools import islice
+
+from sqlalchemy import or_
+
+from db.changes import notify_books_changed
+from db.database import session_scope
+from db.models import Book
+from db.upsert import insert_for
+from services.images import build_covers
+from services.inventory import stock_missing_books
+
+BATCH_SIZE = 1000
+CHUNK_SIZE = 1 << 16
+
+# При повторном импорте существующие книги обновляются только по этим полям,
+# и только если значение действительно изменилось.
+UPDATABLE_FIELDS = ('price', 'description')
+
+
+def read_json_array(f):
+    decoder = json.JSONDecoder()
+    buffer = f.read(CHUNK_SIZE).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('Expected a JSON array of books')
+    buffer = buffer[1:]
+
+    while True:
+        buffer = buffer.lstrip()
+        if buffer.startswith(','):
+            buffer = buffer[1:].lstrip()
+        if buffer.startswith(']'):
+            return
+        try:
+            record, end = decoder.raw_decode(buffer)
+        except json.JSONDecodeError:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                raise
+            buffer += chunk
+            continue
+        yield record
+        buffer = buffer[end:]
+
+
+def read_ndjson(f):
+    for line in f:
+        if line.strip():
+            yield json.loads(line)
+
+
+def read_csv(f):
+    yield from csv.DictReader(f)
+
+
+READERS = {
+    'json': read_json_array,
+    'ndjson': read_ndjson,
+    'jsonl': read_ndjson,
+    'csv': read_csv,
+}
+
+
+def book_row(record):
+    rating = record.get('rating')
+    return {
+        'title': record['title'],
+        'author': record['author'],
+        'price': float(record['price']),
+        'genre': record['genre'],
+        'cover': record['cover'],
+        'description': record['description'],
+        'rating': float(rating) if rating not in (None, '') else None,
+        'year': int(record['year']),
+        'category': record['category'],
+        'subcategory': record['subcategory']
+    }
+
+
+def upsert_batch(session, rows):
+    # Одна и та же пара (title, author) дважды в одном INSERT ... ON CONFLICT недопустима.
+    rows = list({(row['title'], row['author']): row for row in rows}.values())
+
+    table = Book.__table__
+    stmt = insert_for(session.get_bind(), table).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.title, table.c.author],
+        set_={field: stmt.excluded[field] for field in UPDATABLE_FIELDS},
+        where=or_(*[table.c[field].is_distinct_from(stmt.excluded[field]) for field in UPDATABLE_FIELDS])
+    ).returning(table.c.id)
+
+    changed_ids = [row.id for row in session.execute(stmt)]
+    notify_books_changed(session, changed_ids)
+    # Новые книги сразу получают остаток: без строк склада книгу нельзя продать.
+    if changed_ids:
+        stock_missing_books(session, book_ids=changed_ids)
+    return len(changed_ids)
+
+
+def import_books(path, file_format=None, batch_size=BATCH_SIZE, progress=None):
+    file_format = file_format or path.rsplit('.', 1)[-1].lower()
+    reader = READERS[file_format]
+
+    started = time.monotonic()
+    processed = changed = 0
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        records = reader(f)
+        while True:
+            batch = [book_row(record) for record in islice(records, batch_size)]
+            if not batch:
+                break
+            with session_scope() as session:
+                changed += upsert_batch(session, batch)
+            build_covers({row['cover'] for row in batch})
+            processed += len(batch)
+            if progress:
+                progress(processed, changed, processed / max(time.monotonic() - started, 1e-9))
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    return {'processed': processed, 'changed': changed, 'seconds': elapsed, 'rows_per_second': processed / elapsed}
@@ -0,0 +1,166 @@
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import BaseWSGIServer
+
+from config import settings
+from db.database import engine, session_scope
+from db.models import Book
+from routes import cached_catalog_page, catalog_filters
+from services import images
+from services.bestsellers import top_books
+from services.facets import facet_counts
+from services.search import search_books
+
+logger = logging.getLogger(__name__)
+
+
+# Потоки обработки запросов берутся из пула фиксированного размера, а не создаются
+# на каждое соединение, как в ThreadingMixIn: THREADS ограничивает параллелизм воркера.
+# Очередь пула ограничена REQUEST_QUEUE соединениями сверх занятых потоков: при перегрузке
+# новое соединение сразу получает 503, а не копится в памяти.
+class ThreadPoolWSGIServer(BaseWSGIServer):
+
+    multithread = True
+    overloaded_response = (b'HTTP/1.1 503 Service Unavailable\r\nContent-Length: 0\r\n'
+                           b'Retry-After: 1\r\nConnection: close\r\n\r\n')
+
+    def __init__(self, host, port, app, threads, queue_size=None):
+        super().__init__(host, port, app)
+        self.threads = threads
+        self.slots = threading.BoundedSemaphore(threads + (settings.REQUEST_QUEUE if queue_size is None
+                                                           else queue_size))
+        self.executor = None
+
+    def serve_forever(self, poll_interval=0.5):
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='request')
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            self.executor.shutdown(wait=True)
+
+    def process_request(self, request, client_address):
+        if not self.slots.acquire(blocking=False):
+            self.reject_request(request, client_address)
+            return
+        try:
+            self.executor.submit(self.process_request_thread, request, client_address)
+        except RuntimeError:
+            # Пул уже останавливается.
+            self.slots.release()
+            self.shutdown_request(request)
+
+    def reject_request(self, request, client_address):
+        logger.warning('Request queue is full, rejecting %s', client_address[0])
+        try:
+            request.sendall(self.overloaded_response)
+        except OSError:
+            pass
+        self.shutdown_request(request)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+
+# Прогрев выполняется в мастере до fork: скомпилированные шаблоны, кэш каталога
+# (для MemoryBackend), поисковый и фасетный индексы достаются воркерам без повторной работы.
+def warm_up(app):
+    started = time.monotonic()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+    images.manifest.load()
+    with session_scope() as session:
+        top_books(session)
+        search_books(session, 'книга')
+        categories = [category for category, in session.query(Book.category).distinct()]
+
+    for query in [''] + [f'category={category}' for category in categories]:
+        with app.test_request_context(f'/catalog?{query}'):
+            filters = catalog_filters()
+            cached_catalog_page(filters)
+            with session_scope() as session:
+                facet_counts(session, filters)
+    logger.info('Warm-up finished in %.2fs', time.monotonic() - started)
+
+
+def run_worker(server):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # serve_forever нельзя остановить из обработчика сигнала в том же потоке.
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+    server.serve_forever()
+
+
+def serve(app, host=None, port=None, workers=None, threads=None):
+    host = host or settings.APP_HOST
+    port = port or settings.APP_PORT
+    workers = workers or settings.WORKERS or os.cpu_count() or 1
+    threads = threads or settings.THREADS
+    if not hasattr(os, 'fork'):
+        workers = 1
+    if workers > 1 and settings.CACHE_BACKEND == 'memory':
+        logger.warning('CACHE_BACKEND=memory is per process: invalidation in one worker '
+                       'is not visible to others, consider CACHE_BACKEND=sqlite')
+
+    if settings.WARM_UP:
+        warm_up(app)
+    server = ThreadPoolWSGIServer(host, port, app, threads)
+    server.multiprocess = workers > 1
+    logger.warning('Serving on http://%s:%s with %s workers x %s threads', host, port, workers, threads)
+
+    if workers == 1:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    # Мастер сам запросы не обслуживает: его соединения закрываются до fork,
+    # а пулы воркеров сбрасываются в dispose_pool_after_fork.
+    engine.dispose()
+    children = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(server)
+            finally:
+                os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        children.discard(pid)
+        if not stopping:
+            logger.warning('Worker %s exited with status %s, restarting', pid, status)
+            spawn()
+    server.server_close()
@@ -0,0 +1,159 @@
+from datetime import datetime
+
+from sqlalchemy import delete, func, literal, select
+
+from config import settings
+from db.database import session_scope
+from db.models import Book, Order, OrderItem, RollupWatermark, SalesRollupDaily
+from db.upsert import insert_for
+
+WATERMARK = 'sales'
+rollups = SalesRollupDaily.__table__
+
+# Измерение -> выражение значения. Для 'total' значение пустое.
+DIMENSIONS = {
+    'total': literal(''),
+    'genre': Book.genre,
+    'category': Book.category,
+    'payment_method': Order.payment_method,
+    'delivery_method': Order.delivery_method,
+}
+
+
+class ReportError(Exception):
+    pass
+
+
+def rollup_rows(dimension, low_id, high_id):
+    value = DIMENSIONS[dimension]
+    query = select(literal(dimension), Order.date, value, func.count(func.distinct(Order.id)),
+                   func.coalesce(func.sum(OrderItem.book_count), 0), func.coalesce(func.sum(OrderItem.cost), 0)) \
+        .join(OrderItem, OrderItem.order_id == Order.id)
+    if dimension in ('genre', 'category'):
+        query = query.join(Book, Book.id == OrderItem.book_id)
+    group = [Order.date] if dimension == 'total' else [Order.date, value]
+    return query.where(Order.id > low_id, Order.id <= high_id).group_by(*group)
+
+
+# Заказы диапазона (low_id, high_id] прибавляются к уже накопленным суммам всех измерений.
+def add_to_rollups(session, low_id, high_id):
+    for dimension in DIMENSIONS:
+        stmt = insert_for(session.get_bind(), rollups).from_select(
+            ['dimension', 'day', 'value', 'orders', 'sold', 'revenue'], rollup_rows(dimension, low_id, high_id)
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[rollups.c.dimension, rollups.c.day, rollups.c.value],
+            set_={
+                'orders': rollups.c.orders + stmt.excluded.orders,
+                'sold': rollups.c.sold + stmt.excluded.sold,
+                'revenue': rollups.c.revenue + stmt.excluded.revenue,
+            }
+        )
+        session.execute(stmt)
+
+
+def get_watermark(session, name=WATERMARK):
+    watermark = session.get(RollupWatermark, name)
+    if watermark is None:
+        watermark = RollupWatermark(name=name, last_id=0, seen_id=0)
+        session.add(watermark)
+    return watermark
+
+
+# Заказ, получивший меньший id, может зафиксироваться позже большего. Поэтому запуск
+# обрабатывает заказы только до максимального id, замеченного предыдущим запуском:
+# у транзакций, открытых в тот момент, был целый интервал расписания на фиксацию.
+# Каждая порция заказов и сдвиг watermark фиксируются одной транзакцией.
+def advance_watermark(name, apply, chunk_size=None, settle=True, progress=None):
+    chunk_size = chunk_size or settings.ROLLUP_CHUNK_SIZE
+    with session_scope() as session:
+        watermark = get_watermark(session, name)
+        current_max = session.query(func.max(Order.id)).scalar() or 0
+        target = watermark.seen_id if settle else current_max
+        start = watermark.last_id
+
+    processed = start
+    while processed < target:
+        end = min(processed + chunk_size, target)
+        with session_scope() as session:
+            apply(session, processed, end)
+            watermark = get_watermark(session, name)
+            watermark.last_id = end
+            watermark.updated_at = datetime.now()
+        processed = end
+        if progress:
+            progress(f'{name}: orders up to {processed} of {target}')
+
+    with session_scope() as session:
+        watermark = get_watermark(session, name)
+        watermark.seen_id = max(watermark.seen_id, current_max)
+    return processed - start
+
+
+# Кроме отчётов, той же задачей по своим watermark пополняются продажи книг по дням
+# (топ продаж) и матрица совместных покупок. Оформление заказа эти таблицы не трогает:
+# их строки общие для всех покупателей книги и сериализовали бы одновременные заказы.
+def update_sales_rollups(chunk_size=None, settle=True, progress=None):
+    from services.bestsellers import WATERMARK as BOOK_SALES, add_book_sales
+    from services.recommendations import WATERMARK as COPURCHASES, add_copurchases
+
+    processed = advance_watermark(WATERMARK, add_to_rollups, chunk_size, settle, progress)
+    advance_watermark(BOOK_SALES, add_book_sales, chunk_size, settle, progress)
+    advance_watermark(COPURCHASES, add_copurchases, chunk_size, settle, progress)
+    return processed
+
+
+# Полная пересборка: суммы и watermark обнуляются, история проходится порциями по id
+# заказов, поэтому ни приложение, ни база не держат её целиком.
+def backfill_sales_rollups(chunk_size=None, progress=None):
+    with session_scope() as session:
+        session.execute(delete(rollups))
+        watermark = get_watermark(session)
+        watermark.last_id = watermark.seen_id = 0
+    return advance_watermark(WATERMARK, add_to_rollups, chunk_size, settle=False, progress=progress)
+
+
+def sales_report(session, dimension, date_from, date_to, by_day=False):
+    if dimension not in DIMENSIONS:
+        raise ReportError(f'Неизвестное измерение: {dimension}')
+    if date_from > date_to:
+        raise ReportError('Начало периода позже конца')
+
+    columns = [SalesRollupDaily.value, func.sum(SalesRollupDaily.orders), func.sum(SalesRollupDaily.sold),
+               func.sum(SalesRollupDaily.revenue)]
+    group = [SalesRollupDaily.value]
+    if by_day:
+        columns.insert(0, SalesRollupDaily.day)
+        group.insert(0, SalesRollupDaily.day)
+    rows = session.query(*columns) \
+        .filter(SalesRollupDaily.dimension == dimension,
+                SalesRollupDaily.day >= date_from, SalesRollupDaily.day <= date_to) \
+        .group_by(*group) \
+        .order_by(*group).all()
+
+    result = []
+    for row in rows:
+        *key, orders, sold, revenue = row
+        entry = {'value': key[-1], 'orders': orders, 'sold': sold, 'revenue': round(revenue or 0, 2)}
+        if by_day:
+            entry['day'] = key[0].isoformat()
+        result.append(entry)
+    return result
+
+
+# Заказ с книгами нескольких жанров входит в строку каждого жанра, поэтому итоги
+# берутся из измерения 'total', где каждый заказ учтён один раз.
+def sales_totals(session, date_from, date_to):
+    orders, sold, revenue = session.query(
+        func.sum(SalesRollupDaily.orders), func.sum(SalesRollupDaily.sold), func.sum(SalesRollupDaily.revenue)
+    ).filter(SalesRollupDaily.dimension == 'total',
+             SalesRollupDaily.day >= date_from, SalesRollupDaily.day <= date_to).one()
+    return {'orders': orders or 0, 'sold': sold or 0, 'revenue': round(revenue or 0, 2)}
+
+
+def rollup_status(session):
+    watermark = session.get(RollupWatermark, WATERMARK)
+    return {
+        'last_order_id': watermark.last_id if watermark else 0,
+        'updated_at': watermark.updated_at.isoformat() if watermark and watermark.updated_at else None,
+    }
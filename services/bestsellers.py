@@ -0,0 +1,67 @@
+from datetime import date, timedelta
+
+from sqlalchemy import func, insert, select
+
+from config import settings
+from db.database import primary_session
+from db.models import Book, BookSalesDaily, Order, OrderItem
+from db.upsert import insert_for
+from services.analytics import get_watermark
+from services.cache import MISSING, cache
+from services.read_models import BOOK_CARD_COLUMNS, BestsellerCard
+
+WATERMARK = 'book_sales'
+
+
+# Заказы диапазона (low_id, high_id] прибавляются к продажам по дням задачей rollup-sales.
+def add_book_sales(session, low_id, high_id):
+    table = BookSalesDaily.__table__
+    stmt = insert_for(session.get_bind(), table).from_select(
+        ['day', 'book_id', 'sold'],
+        select(Order.date, OrderItem.book_id, func.sum(OrderItem.book_count))
+        .join(Order, OrderItem.order_id == Order.id)
+        .where(Order.id > low_id, Order.id <= high_id)
+        .group_by(Order.date, OrderItem.book_id)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.day, table.c.book_id],
+        set_={'sold': table.c.sold + stmt.excluded.sold}
+    )
+    session.execute(stmt)
+
+
+def top_books(session, limit=3, days=7):
+    key = cache.key('books', 'top', date.today(), limit, days)
+    cached = cache.get(key)
+    if cached is not MISSING:
+        return cached
+
+    since = date.today() - timedelta(days=days)
+    total_sold = func.sum(BookSalesDaily.sold).label('total_sold')
+    top = session.query(BookSalesDaily.book_id, total_sold) \
+        .filter(BookSalesDaily.day >= since) \
+        .group_by(BookSalesDaily.book_id) \
+        .order_by(total_sold.desc(), BookSalesDaily.book_id) \
+        .limit(limit).subquery()
+    query = select(*BOOK_CARD_COLUMNS, top.c.total_sold) \
+        .join(top, Book.id == top.c.book_id) \
+        .order_by(top.c.total_sold.desc(), Book.id)
+    # Как и карточки книг, топ кэшируется только с основной базы.
+    with primary_session(session) as primary:
+        books_data = [BestsellerCard._make(row) for row in primary.execute(query)]
+
+    cache.set(key, books_data, settings.BESTSELLERS_CACHE_TTL)
+    return books_data
+
+
+def rebuild_sales_rollup(session):
+    last_id = session.query(func.max(Order.id)).scalar() or 0
+    session.query(BookSalesDaily).delete()
+    rollup = session.query(Order.date, OrderItem.book_id, func.coalesce(func.sum(OrderItem.book_count), 0)) \
+        .join(Order, OrderItem.order_id == Order.id) \
+        .filter(Order.id <= last_id) \
+        .group_by(Order.date, OrderItem.book_id)
+    session.execute(insert(BookSalesDaily).from_select(['day', 'book_id', 'sold'], rollup))
+    watermark = get_watermark(session, WATERMARK)
+    watermark.last_id = watermark.seen_id = last_id
+    cache.bump('books')
@@ -0,0 +1,199 @@
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+
+from config import settings
+
+MISSING = object()
+
+
+class CacheStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def add(self, hits=0, misses=0, evictions=0):
+        with self.lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def as_dict(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+
+class MemoryBackend:
+
+    def __init__(self, max_entries, stats):
+        self.max_entries = max_entries
+        self.stats = stats
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.counters = {}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return MISSING
+            expires, value = entry
+            if expires is not None and expires <= time.time():
+                del self.entries[key]
+                return MISSING
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.time() + ttl if ttl else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            evicted = 0
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.add(evictions=evicted)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def counter(self, key):
+        return self.counters.get(key, 0)
+
+    def incr(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+            return self.counters[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+# Локальная замена общего хранилища (Redis/memcached): файл SQLite, который видят
+# все процессы на машине, поэтому инвалидация в одном воркере видна остальным.
+class SqliteBackend:
+
+    def __init__(self, path, max_entries, stats, table='cache'):
+        self.path = path
+        self.max_entries = max_entries
+        self.stats = stats
+        self.table = table
+        with self._connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS {table} ('
+                               'key TEXT PRIMARY KEY, value BLOB, expires REAL, accessed REAL)')
+            connection.execute(f'CREATE INDEX IF NOT EXISTS idx_{table}_accessed ON {table} (accessed)')
+            connection.execute('CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER)')
+
+    @contextmanager
+    def _connect(self):
+        with closing(sqlite3.connect(self.path, timeout=5, isolation_level=None)) as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+            yield connection
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as connection:
+            row = connection.execute(f'SELECT value, expires FROM {self.table} WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return MISSING
+            if row[1] is not None and row[1] <= now:
+                connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+                return MISSING
+            connection.execute(f'UPDATE {self.table} SET accessed = ? WHERE key = ?', (now, key))
+        return pickle.loads(row[0])
+
+    def set(self, key, value, ttl=None):
+        now = time.time()
+        expires = now + ttl if ttl else None
+        with self._connect() as connection:
+            connection.execute(f'INSERT OR REPLACE INTO {self.table} (key, value, expires, accessed) VALUES (?, ?, ?, ?)',
+                               (key, pickle.dumps(value), expires, now))
+            evicted = connection.execute(
+                f'DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} ORDER BY accessed LIMIT '
+                f'max(0, (SELECT count(*) FROM {self.table}) - ?))', (self.max_entries,)).rowcount
+        if evicted:
+            self.stats.add(evictions=evicted)
+
+    def delete(self, key):
+        with self._connect() as connection:
+            connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+
+    def counter(self, key):
+        with self._connect() as connection:
+            row = connection.execute('SELECT value FROM counters WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def incr(self, key):
+        with self._connect() as connection:
+            return connection.execute('INSERT INTO counters (key, value) VALUES (?, 1) '
+                                      'ON CONFLICT (key) DO UPDATE SET value = value + 1 '
+                                      'RETURNING value', (key,)).fetchone()[0]
+
+    def clear(self):
+        with self._connect() as connection:
+            connection.execute(f'DELETE FROM {self.table}')
+
+
+class Cache:
+
+    def __init__(self, backend, stats):
+        self.backend = backend
+        self.stats = stats
+
+    def get(self, key):
+        value = self.backend.get(key)
+        if value is MISSING:
+            self.stats.add(misses=1)
+        else:
+            self.stats.add(hits=1)
+        return value
+
+    def set(self, key, value, ttl=None):
+        self.backend.set(key, value, ttl or settings.CACHE_TTL)
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def get_or_set(self, key, factory, ttl=None):
+        value = self.get(key)
+        if value is MISSING:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+    # Поколение пространства имён входит в ключ, поэтому его увеличение разом
+    # делает недоступными все записи пространства без перебора ключей.
+    # Счётчики поколений хранятся отдельно от записей и не вытесняются LRU.
+    def generation(self, namespace):
+        return self.backend.counter(f'generation:{namespace}')
+
+    def bump(self, namespace):
+        return self.backend.incr(f'generation:{namespace}')
+
+    def key(self, namespace, *parts):
+        return ':'.join([namespace, str(self.generation(namespace))] + [str(part) for part in parts])
+
+    def clear(self):
+        self.backend.clear()
+
+
+def create_cache(name='cache', max_entries=None):
+    stats = CacheStats()
+    max_entries = max_entries or settings.CACHE_MAX_ENTRIES
+    if settings.CACHE_BACKEND == 'sqlite':
+        backend = SqliteBackend(settings.CACHE_SQLITE_PATH, max_entries, stats, table=name)
+    else:
+        backend = MemoryBackend(max_entries, stats)
+    return Cache(backend, stats)
+
+
+cache = create_cache()
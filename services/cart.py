@@ -0,0 +1,101 @@
+from sqlalchemy import case, delete, literal, select, update
+
+from db.models import Book, CartItem
+from db.upsert import insert_for
+
+cart_items = CartItem.__table__
+books = Book.__table__
+
+
+class UnknownBookError(Exception):
+
+    def __init__(self, book_ids):
+        super().__init__(f'Unknown books {sorted(book_ids)}')
+        self.book_ids = book_ids
+
+
+# Каждая операция — один SQL-оператор: счётчик меняется в базе атомарно,
+# поэтому быстрые повторные клики не теряют инкременты. Строки корзины вставляются
+# через INSERT ... SELECT из books: на SQLite внешние ключи не проверяются, и
+# несуществующая книга иначе молча попала бы в корзину. Если строка не вернулась,
+# книги нет, а исключение откатывает транзакцию.
+def add_item(session, user_id, book_id, count=1):
+    stmt = insert_for(session.get_bind(), cart_items).from_select(
+        ['user_id', 'book_id', 'count'],
+        select(literal(user_id), books.c.id, literal(count)).where(books.c.id == book_id)
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[cart_items.c.user_id, cart_items.c.book_id],
+        set_={'count': cart_items.c.count + stmt.excluded.count}
+    ).returning(cart_items.c.count)
+    count = session.execute(stmt).scalar()
+    if count is None:
+        raise UnknownBookError({book_id})
+    return count
+
+
+def set_quantities(session, user_id, quantities):
+    to_remove = [book_id for book_id, count in quantities.items() if count <= 0]
+    to_set = {book_id: count for book_id, count in quantities.items() if count > 0}
+
+    if to_remove:
+        session.execute(delete(cart_items).where(cart_items.c.user_id == user_id,
+                                                 cart_items.c.book_id.in_(to_remove)))
+    if to_set:
+        stmt = insert_for(session.get_bind(), cart_items).from_select(
+            ['user_id', 'book_id', 'count'],
+            select(literal(user_id), books.c.id, case(to_set, value=books.c.id)).where(books.c.id.in_(to_set))
+        )
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[cart_items.c.user_id, cart_items.c.book_id],
+            set_={'count': stmt.excluded.count}
+        ).returning(cart_items.c.book_id)
+        unknown = set(to_set) - set(session.execute(stmt).scalars())
+        if unknown:
+            raise UnknownBookError(unknown)
+
+
+def set_quantity(session, user_id, book_id, count):
+    set_quantities(session, user_id, {book_id: count})
+    return max(count, 0)
+
+
+def decrease_item(session, user_id, book_id):
+    count = session.execute(
+        update(cart_items)
+        .where(cart_items.c.user_id == user_id, cart_items.c.book_id == book_id, cart_items.c.count > 1)
+        .values(count=cart_items.c.count - 1)
+        .returning(cart_items.c.count)
+    ).scalar()
+    if count is None:
+        remove_item(session, user_id, book_id)
+        return 0
+    return count
+
+
+def remove_item(session, user_id, book_id):
+    session.execute(delete(cart_items).where(cart_items.c.user_id == user_id, cart_items.c.book_id == book_id))
+
+
+def cart_summary(session, user_id):
+    rows = session.execute(
+        select(books.c.id, books.c.title, books.c.author, books.c.price, books.c.cover, cart_items.c.count)
+        .join(books, books.c.id == cart_items.c.book_id)
+        .where(cart_items.c.user_id == user_id)
+        .order_by(books.c.title)
+    ).all()
+
+    items = [{
+        'book_id': row.id,
+        'title': row.title,
+        'author': row.author,
+        'price': row.price,
+        'cover': row.cover,
+        'count': row.count,
+        'cost': row.count * row.price
+    } for row in rows]
+    return {
+        'items': items,
+        'total_count': sum(item['count'] for item in items),
+        'total_price': round(sum(item['cost'] for item in items), 2)
+    }
@@ -0,0 +1,62 @@
+import threading
+
+from db.changes import BookChangeFeed, on_books_changed
+from db.database import primary_session, session_scope
+from services.cache import MISSING, cache
+from services.read_models import book_cards_by_id
+
+
+def get_book_cards(session, book_ids):
+    found = {}
+    for book_id in book_ids:
+        book = cache.get(f'book_card:{book_id}')
+        if book is not MISSING:
+            found[book_id] = book
+
+    missing = [book_id for book_id in book_ids if book_id not in found]
+    # Кэш заполняется только с основной базы: строка с отстающей реплики после
+    # инвалидации осталась бы в кэше до истечения TTL.
+    if missing:
+        with primary_session(session) as primary:
+            cards = book_cards_by_id(primary, missing)
+        for book_id, book in cards.items():
+            found[book_id] = book
+            cache.set(f'book_card:{book_id}', book)
+
+    return [found[book_id] for book_id in book_ids if book_id in found]
+
+
+@on_books_changed
+def invalidate_books(book_ids):
+    cache.bump('books')
+    for book_id in book_ids:
+        cache.delete(f'book_card:{book_id}')
+
+
+changes = BookChangeFeed()
+changes_lock = threading.Lock()
+
+
+# Слушатель выше видит только изменения своего процесса. Изменения из других воркеров
+# и CLI-команд (import-books, init_books_data) приходят через журнал book_changes.
+def sync_book_changes():
+    if not changes.due():
+        return
+    with changes_lock:
+        if not changes.due():
+            return
+        with session_scope() as session:
+            if changes.last_id is None:
+                changes.reset(session)
+                return
+            changed = changes.read(session)
+    if changed is None:
+        cache.clear()
+        cache.bump('books')
+    elif changed:
+        invalidate_books(changed)
+
+
+# Позиция журнала одинакова во всех процессах, в отличие от поколений кэша в памяти.
+def book_changes_position():
+    return changes.last_id or 0
@@ -0,0 +1,151 @@
+import csv
+import io
+import json
+from datetime import date
+
+from sqlalchemy import Date, Float, Integer, String, select
+
+from config import settings
+from db.database import session_scope
+from db.models import Book, Order, OrderItem
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+BOOK_COLUMNS = (Book.id, Book.title, Book.author, Book.price, Book.genre, Book.category, Book.subcategory,
+                Book.year, Book.rating, Book.rating_count, Book.cover)
+# Одна строка на позицию заказа: так выгрузку можно сразу сводить по книгам и заказам.
+ORDER_COLUMNS = (Order.id.label('order_id'), Order.date, Order.user_id, Order.status, Order.payment_method,
+                 Order.delivery_method, Order.total_amount, OrderItem.book_id, Book.category,
+                 OrderItem.book_count, OrderItem.cost)
+
+
+class ExportError(Exception):
+    pass
+
+
+def books_query(filters):
+    query = select(*BOOK_COLUMNS)
+    if filters.get('category'):
+        query = query.where(Book.category.in_(filters['category']))
+    return query.order_by(Book.id)
+
+
+def orders_query(filters):
+    query = select(*ORDER_COLUMNS) \
+        .join(OrderItem, OrderItem.order_id == Order.id) \
+        .join(Book, Book.id == OrderItem.book_id)
+    if filters.get('date_from'):
+        query = query.where(Order.date >= filters['date_from'])
+    if filters.get('date_to'):
+        query = query.where(Order.date <= filters['date_to'])
+    if filters.get('category'):
+        query = query.where(Book.category.in_(filters['category']))
+    return query.order_by(Order.id, OrderItem.id)
+
+
+EXPORTS = {
+    'books': books_query,
+    'orders': orders_query,
+}
+
+
+# yield_per со stream_results читает строки серверным курсором (на PostgreSQL) пачками:
+# в памяти одновременно находится не больше одной пачки, сколько бы строк ни было в таблице.
+def iter_batches(name, filters, batch_size=None):
+    query = EXPORTS[name](filters).execution_options(yield_per=batch_size or settings.EXPORT_BATCH_SIZE,
+                                                     stream_results=True)
+    with session_scope(readonly=True) as session:
+        result = session.execute(query)
+        columns = list(result.keys())
+        for batch in result.partitions():
+            yield columns, batch
+
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def csv_chunks(batches):
+    header = True
+    for columns, batch in batches:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        if header:
+            writer.writerow(columns)
+            header = False
+        writer.writerows(batch)
+        yield buffer.getvalue().encode()
+
+
+def ndjson_chunks(batches):
+    for columns, batch in batches:
+        lines = (json.dumps({column: json_value(value) for column, value in zip(columns, row)}, ensure_ascii=False)
+                 for row in batch)
+        yield ('\n'.join(lines) + '\n').encode()
+
+
+class ChunkSink(io.RawIOBase):
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data, self.chunks = b''.join(self.chunks), []
+        return data
+
+
+def arrow_schema(query):
+    types = {Integer: pyarrow.int64(), Float: pyarrow.float64(), String: pyarrow.string(), Date: pyarrow.date32()}
+    fields = []
+    for column in query.selected_columns:
+        arrow_type = next(arrow_type for sql_type, arrow_type in types.items() if isinstance(column.type, sql_type))
+        fields.append(pyarrow.field(column.name, arrow_type))
+    return pyarrow.schema(fields)
+
+
+# Каждая пачка становится группой строк Parquet; записанные байты сразу отдаются
+# клиенту, футер с метаданными уходит последним.
+def parquet_chunks(batches, schema):
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    try:
+        for columns, batch in batches:
+            table = pyarrow.Table.from_pylist([dict(zip(columns, row)) for row in batch], schema=schema)
+            writer.write_table(table)
+            yield sink.drain()
+    finally:
+        writer.close()
+    yield sink.drain()
+
+
+def export_chunks(name, file_format, filters, batch_size=None):
+    if name not in EXPORTS:
+        raise ExportError(f'Неизвестная выгрузка: {name}')
+    if file_format not in FORMATS:
+        raise ExportError(f'Неизвестный формат: {file_format}')
+    if file_format == 'parquet' and pyarrow is None:
+        raise ExportError('Для выгрузки в Parquet нужен пакет pyarrow')
+
+    batches = iter_batches(name, filters, batch_size)
+    if file_format == 'csv':
+        return csv_chunks(batches)
+    if file_format == 'ndjson':
+        return ndjson_chunks(batches)
+    return parquet_chunks(batches, arrow_schema(EXPORTS[name](filters)))
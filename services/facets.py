@@ -0,0 +1,298 @@
+import bisect
+import heapq
+import re
+import threading
+from collections import defaultdict
+
+from db.changes import BookChangeFeed, on_books_changed
+from db.database import primary_session
+from db.models import Book
+from services.pagination import decode_cursor, encode_cursor
+
+CATEGORY_LABELS = {
+    'fiction': 'Художественная литература',
+    'nonfiction': 'Нехудожественная литература',
+    'children': 'Детская литература',
+    'business': 'Бизнес-литература',
+    'educational': 'Учебная литература',
+    'foreign_language': 'Книги на иностранном языке',
+    'comics_manga': 'Комиксы, манга, артбуки',
+}
+SUBCATEGORY_LABELS = {
+    'foreign_modern': 'Зарубежная современная литература',
+    'foreign_classic': 'Зарубежная классическая литература',
+    'russian_modern': 'Русская современная литература',
+    'russian_classic': 'Русская классическая литература',
+    'fantasy': 'Фантастика, фэнтези',
+    'detective': 'Детектив',
+    'romance': 'Любовный роман',
+    'belarusian': 'Белорусская литература',
+    'scientific': 'Научная и специальная литература',
+    'popular_science': 'Научно-популярная литература',
+    'home_cooking': 'Домашний мир, кулинария',
+    'travel': 'Путеводители, карты, ПДД',
+    'languages': 'Иностранные языки',
+    'creativity': 'Творчество, саморазвитие',
+    'it': 'ИТ-литература',
+    'beauty_sport': 'Красота, спорт, питание',
+    'fiction': 'Художественная литература',
+    'children_fiction': 'Художественная литература',
+    'children_educational': 'Развивающая литература',
+    'children_leisure': 'Досуг, творчество',
+    'children_encyclopedias': 'Энциклопедии',
+    'children_interactive': 'Интерактивные, игровые книги',
+    'parents_books': 'Книги для родителей',
+    'business_selfdev': 'Саморазвитие, карьера',
+    'business_management': 'Менеджмент, управление',
+    'business_marketing': 'Маркетинг, реклама',
+    'business_success': 'Истории успеха',
+    'business_entrepreneurship': 'Предпринимательство',
+    'exam_preparation': 'Подготовка к экзаменам и ЦТ',
+    'workbooks': 'Рабочие тетради для школьников',
+    'english_books': 'Английский',
+    'french_books': 'Французский',
+    'german_books': 'Немецкий',
+    'comics_manga': 'Комиксы, манга, артбуки',
+}
+
+# Границы ценовых корзин; ключ корзины — строка вида '500-1000' ('2000-' для последней).
+PRICE_EDGES = (0, 300, 500, 1000, 2000)
+PRICE_BUCKETS = [f'{low}-{high}' for low, high in zip(PRICE_EDGES, PRICE_EDGES[1:])] + [f'{PRICE_EDGES[-1]}-']
+RATING_THRESHOLDS = (4.5, 4, 3, 2, 1)
+VALUE_FACETS = ('category', 'subcategory', 'genre', 'price')
+
+# Ключи сортировки каталога по возрастанию: для сортировок «по убыванию» значения берутся
+# с обратным знаком, id книги — второй ключ, поэтому курсор однозначно задаёт позицию.
+SORT_KEYS = {
+    'default': lambda row: (0, row.id),
+    'price': lambda row: (row.price, row.id),
+    'price_desc': lambda row: (-row.price, -row.id),
+    'year': lambda row: (row.year, row.id),
+    'year_desc': lambda row: (-row.year, -row.id),
+    'rating': lambda row: (-(row.rating or 0), -row.id),
+}
+
+NONZERO = re.compile(rb'[^\x00]')
+BYTE_BITS = [[bit for bit in range(8) if byte >> bit & 1] for byte in range(256)]
+
+
+def price_bucket(price):
+    return PRICE_BUCKETS[bisect.bisect_right(PRICE_EDGES, price) - 1]
+
+
+def set_bits(mask, size):
+    data = mask.to_bytes((size + 7) // 8, 'little')
+    slots = []
+    for match in NONZERO.finditer(data):
+        base = match.start() * 8
+        slots.extend(base + bit for bit in BYTE_BITS[data[match.start()]])
+    return slots
+
+
+# Каждому значению фасета соответствует битовое множество (int) над «слотами» книг.
+# Пересечение фильтров и подсчёт — это & и int.bit_count(), без обращений к базе.
+class FacetIndex:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.changes = BookChangeFeed()
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.pending = set()
+        self.rows = []
+        self.slots = {}
+        self.all = 0
+        self.values = {facet: defaultdict(int) for facet in VALUE_FACETS}
+        self.years = defaultdict(int)
+        self.ratings = defaultdict(int)
+        self.orders = {sort: [] for sort in SORT_KEYS}
+
+    def load(self, session):
+        with self.lock:
+            self._reset()
+            for row in session.query(*self.columns()).order_by(Book.id):
+                self._add(row)
+            for sort, key in SORT_KEYS.items():
+                self.orders[sort] = sorted((row for row in self.rows if row is not None), key=key)
+            self.loaded = True
+
+    @staticmethod
+    def columns():
+        return Book.id, Book.category, Book.subcategory, Book.genre, Book.price, Book.year, Book.rating
+
+    def mark_changed(self, book_ids):
+        with self.lock:
+            self.pending.update(book_ids)
+
+    # Изменения из этого процесса применяются сразу после фиксации, изменения других
+    # воркеров и CLI-команд — по журналу book_changes не реже раза в BOOK_CHANGES_POLL_SECONDS.
+    def refresh(self, session):
+        with self.lock:
+            if self.loaded and not self.pending and not self.changes.due():
+                return
+            with primary_session(session) as session:
+                if self.loaded and self.changes.due():
+                    changed = self.changes.read(session)
+                    if changed is None:
+                        self.loaded = False
+                    else:
+                        self.pending.update(changed)
+                # Массовые изменения (импорт, пересчёт рейтингов) дешевле применить перестроением.
+                if not self.loaded or len(self.pending) > max(1000, len(self.slots) // 10):
+                    self.changes.reset(session)
+                    self.load(session)
+                elif self.pending:
+                    book_ids, self.pending = self.pending, set()
+                    for book_id in book_ids:
+                        self._remove(book_id)
+                    for row in session.query(*self.columns()).filter(Book.id.in_(book_ids)):
+                        slot = self._add(row)
+                        for sort, key in SORT_KEYS.items():
+                            bisect.insort(self.orders[sort], self.rows[slot], key=key)
+
+    def _add(self, row):
+        slot = self.slots.get(row.id)
+        if slot is None:
+            slot = self.slots[row.id] = len(self.rows)
+            self.rows.append(row)
+        else:
+            self.rows[slot] = row
+        bit = 1 << slot
+        self.all |= bit
+        for facet in ('category', 'subcategory', 'genre'):
+            self.values[facet][getattr(row, facet)] |= bit
+        self.values['price'][price_bucket(row.price)] |= bit
+        self.years[row.year] |= bit
+        for threshold in RATING_THRESHOLDS:
+            if (row.rating or 0) >= threshold:
+                self.ratings[threshold] |= bit
+        return slot
+
+    def _remove(self, book_id):
+        slot = self.slots.get(book_id)
+        if slot is None or self.rows[slot] is None:
+            return
+        row, clear = self.rows[slot], ~(1 << slot)
+        for sort, key in SORT_KEYS.items():
+            order = self.orders[sort]
+            position = bisect.bisect_left(order, key(row), key=key)
+            if position < len(order) and order[position].id == book_id:
+                del order[position]
+
+        self.all &= clear
+        buckets = [(self.values[facet], getattr(row, facet)) for facet in ('category', 'subcategory', 'genre')]
+        buckets.append((self.values['price'], price_bucket(row.price)))
+        buckets.append((self.years, row.year))
+        buckets.extend((self.ratings, threshold) for threshold in RATING_THRESHOLDS if (row.rating or 0) >= threshold)
+        for bitsets, value in buckets:
+            bitsets[value] &= clear
+            if not bitsets[value]:
+                del bitsets[value]
+        self.rows[slot] = None
+
+    def _masks(self, filters):
+        masks = {}
+        for facet in VALUE_FACETS:
+            if filters.get(facet):
+                mask = 0
+                for value in filters[facet]:
+                    mask |= self.values[facet].get(value, 0)
+                masks[facet] = mask
+        if filters.get('year_from') is not None or filters.get('year_to') is not None:
+            low = filters.get('year_from') if filters.get('year_from') is not None else -10 ** 6
+            high = filters.get('year_to') if filters.get('year_to') is not None else 10 ** 6
+            mask = 0
+            for year, bits in self.years.items():
+                if low <= year <= high:
+                    mask |= bits
+            masks['year'] = mask
+        if filters.get('min_rating'):
+            masks['rating'] = self.ratings.get(filters['min_rating'], 0)
+        return masks
+
+    def _combine(self, masks, skip=None):
+        result = self.all
+        for facet, mask in masks.items():
+            if facet != skip:
+                result &= mask
+        return result
+
+    # Внутри фасета значения объединяются (ИЛИ), фасеты пересекаются (И). Счётчик значения
+    # считается с учётом всех фильтров, кроме фильтра его же фасета.
+    def counts(self, filters):
+        with self.lock:
+            masks = self._masks(filters)
+            result = {}
+            for facet in VALUE_FACETS:
+                base = self._combine(masks, skip=facet)
+                result[facet] = {value: (bits & base).bit_count() for value, bits in self.values[facet].items()
+                                 if bits & base}
+            base = self._combine(masks, skip='year')
+            decades = defaultdict(int)
+            for year, bits in self.years.items():
+                count = (bits & base).bit_count()
+                if count:
+                    decades[year // 10 * 10] += count
+            result['decade'] = dict(decades)
+            base = self._combine(masks, skip='rating')
+            result['rating'] = {threshold: (self.ratings.get(threshold, 0) & base).bit_count()
+                                for threshold in RATING_THRESHOLDS}
+            result['total'] = self._combine(masks).bit_count()
+            return result
+
+    def page(self, filters, sort=None, cursor=None, limit=24):
+        sort = sort if sort in SORT_KEYS else 'default'
+        key = SORT_KEYS[sort]
+        decoded = decode_cursor(cursor) if cursor else None
+        # Все ключи сортировки числовые; курсор с другими значениями игнорируется.
+        if decoded and (isinstance(decoded[0], bool) or not isinstance(decoded[0], (int, float))):
+            decoded = None
+        after = tuple(decoded) if decoded else None
+        with self.lock:
+            mask = self._combine(self._masks(filters))
+            order = self.orders[sort]
+            total = mask.bit_count()
+            # Редкий фильтр: быстрее достать слоты из маски и выбрать первые по ключу;
+            # частый — пройти по заранее отсортированному списку, проверяя биты.
+            if total * 20 < len(order):
+                rows = [self.rows[slot] for slot in set_bits(mask, len(self.rows))]
+                if after:
+                    rows = [row for row in rows if key(row) > after]
+                rows = heapq.nsmallest(limit + 1, rows, key=key)
+            else:
+                data = mask.to_bytes((len(self.rows) + 7) // 8, 'little')
+                start = bisect.bisect_right(order, after, key=key) if after else 0
+                rows = []
+                for position in range(start, len(order)):
+                    row = order[position]
+                    slot = self.slots[row.id]
+                    if data[slot >> 3] >> (slot & 7) & 1:
+                        rows.append(row)
+                        if len(rows) > limit:
+                            break
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(*key(rows[-1]))
+        return [row.id for row in rows], next_cursor, total
+
+
+facet_index = FacetIndex()
+
+
+def facet_page(session, filters, sort=None, cursor=None, limit=24):
+    facet_index.refresh(session)
+    return facet_index.page(filters, sort, cursor, limit)
+
+
+def facet_counts(session, filters):
+    facet_index.refresh(session)
+    return facet_index.counts(filters)
+
+
+@on_books_changed
+def mark_facets_changed(book_ids):
+    facet_index.mark_changed(book_ids)
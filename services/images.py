@@ -0,0 +1,160 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+
+from flask import url_for
+
+from config import settings
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Ширина производных обложек в пикселях.
+SIZES = {'thumb': 200, 'medium': 400}
+MANIFEST_NAME = 'manifest.json'
+PLACEHOLDER = 'images/placeholder.svg'
+# Год в секундах: имена файлов содержат хэш содержимого и никогда не переиспользуются.
+MAX_AGE = 365 * 24 * 3600
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SOURCE_DIR = os.path.join(BASE_DIR, settings.COVERS_SOURCE_DIR)
+OUTPUT_DIR = os.path.join(BASE_DIR, settings.COVERS_OUTPUT_DIR)
+
+
+class CoverManifest:
+
+    def __init__(self, output_dir):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.mtime = None
+
+    # Манифест перечитывается, только если его переписал другой процесс.
+    def load(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return self.entries
+        if mtime != self.mtime:
+            with self.lock:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+                self.mtime = mtime
+        return self.entries
+
+    def save(self):
+        tmp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+        self.mtime = os.stat(self.path).st_mtime_ns
+
+
+manifest = CoverManifest(OUTPUT_DIR)
+
+
+def fingerprint(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def build_variants(source_path, name, digest):
+    stem, ext = os.path.splitext(name)
+    original = f'{stem}.{digest}{ext}'
+    shutil.copyfile(source_path, os.path.join(manifest.output_dir, original))
+    variants = {'original': {'file': original, 'width': None}}
+
+    if Image is None:
+        return variants
+
+    with Image.open(source_path) as image:
+        variants['original']['width'] = image.width
+        for size_name, width in SIZES.items():
+            if image.width <= width:
+                continue
+            height = round(image.height * width / image.width)
+            file_name = f'{stem}.{size_name}.{digest}{ext}'
+            image.resize((width, height), Image.LANCZOS).save(os.path.join(manifest.output_dir, file_name))
+            variants[size_name] = {'file': file_name, 'width': width}
+    return variants
+
+
+def remove_variants(entry):
+    for variant in entry.get('variants', {}).values():
+        try:
+            os.remove(os.path.join(manifest.output_dir, variant['file']))
+        except FileNotFoundError:
+            pass
+
+
+# Обрабатываются только новые и изменившиеся обложки (по размеру и mtime файла),
+# поэтому повторный запуск после импорта дешёвый.
+def build_covers(names=None):
+    os.makedirs(manifest.output_dir, exist_ok=True)
+    entries = manifest.load()
+    names = sorted(names) if names is not None else sorted(os.listdir(SOURCE_DIR))
+
+    built = touched = 0
+    for name in names:
+        source_path = os.path.join(SOURCE_DIR, name)
+        try:
+            stat = os.stat(source_path)
+        except FileNotFoundError:
+            continue
+        entry = entries.get(name)
+        if entry and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            continue
+
+        digest = fingerprint(source_path)
+        if entry and entry['hash'] == digest and (Image is None or len(entry['variants']) > 1):
+            entry.update(size=stat.st_size, mtime=stat.st_mtime_ns)
+            touched += 1
+            continue
+        if entry:
+            remove_variants(entry)
+        try:
+            variants = build_variants(source_path, name, digest)
+        except OSError as error:
+            logger.warning('Cannot process cover %s: %s', name, error)
+            continue
+        entries[name] = {'hash': digest, 'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'variants': variants}
+        built += 1
+
+    if built or touched:
+        manifest.save()
+    return built
+
+
+def cover_url(cover, size='medium'):
+    if not cover:
+        return url_for('static', filename=PLACEHOLDER)
+    entry = manifest.load().get(cover)
+    if not entry:
+        return url_for('static', filename=f'images/books/{cover}')
+    variant = entry['variants'].get(size) or entry['variants']['original']
+    return url_for('main.cover_file', filename=variant['file'])
+
+
+def cover_srcset(cover):
+    entry = manifest.load().get(cover) if cover else None
+    if not entry:
+        return ''
+    variants = sorted((variant for variant in entry['variants'].values() if variant['width']),
+                      key=lambda variant: variant['width'])
+    return ', '.join(f"{url_for('main.cover_file', filename=variant['file'])} {variant['width']}w"
+                     for variant in variants)
+
+
+def placeholder_url():
+    return url_for('static', filename=PLACEHOLDER)
@@ -0,0 +1,191 @@
+import random
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import case, delete, func, insert, select, update
+
+from config import settings
+from db.models import Book, BookStock, CartItem, StockReservation
+
+stock = BookStock.__table__
+reservations = StockReservation.__table__
+cart_items = CartItem.__table__
+
+
+class OutOfStockError(Exception):
+
+    def __init__(self, book_ids):
+        super().__init__(f'Not enough stock for books {sorted(book_ids)}')
+        self.book_ids = book_ids
+
+
+def shard_quantities(quantity, shards=None):
+    shards = shards or settings.STOCK_SHARDS
+    return [quantity // shards + (1 if shard < quantity % shards else 0) for shard in range(shards)]
+
+
+def set_stock(session, book_id, quantity, shards=None):
+    session.execute(delete(stock).where(stock.c.book_id == book_id))
+    session.execute(insert(stock), [{'book_id': book_id, 'shard': shard, 'quantity': amount}
+                                    for shard, amount in enumerate(shard_quantities(quantity, shards))])
+
+
+# Книгам без строк остатка (новым после импорта) выдаётся одинаковый начальный остаток.
+def stock_missing_books(session, quantity=None, shards=None, book_ids=None):
+    quantity = settings.INITIAL_STOCK if quantity is None else quantity
+    untracked = select(Book.id).where(~select(stock.c.book_id).where(stock.c.book_id == Book.id).exists())
+    if book_ids is not None:
+        untracked = untracked.where(Book.id.in_(book_ids))
+    untracked = untracked.subquery()
+    book_ids = [book_id for book_id, in session.execute(select(untracked.c.id))]
+    if not book_ids:
+        return 0
+    for shard, amount in enumerate(shard_quantities(quantity, shards)):
+        session.execute(insert(stock), [{'book_id': book_id, 'shard': shard, 'quantity': amount}
+                                        for book_id in book_ids])
+    return len(book_ids)
+
+
+def stock_levels(session, book_ids):
+    rows = session.query(BookStock.book_id, func.sum(BookStock.quantity)) \
+        .filter(BookStock.book_id.in_(book_ids)) \
+        .group_by(BookStock.book_id)
+    return {book_id: quantity for book_id, quantity in rows}
+
+
+def lock_shards(session, condition):
+    return session.execute(
+        select(stock.c.book_id, stock.c.shard, stock.c.quantity).where(condition)
+        .order_by(stock.c.book_id, stock.c.shard).with_for_update()
+    ).all()
+
+
+# Быстрый путь: все книги меняются в одном шарде одним условным UPDATE
+# (quantity + delta >= 0), строки предварительно блокируются по возрастанию id книги.
+# Возвращает id книг, которые удалось изменить.
+def change_in_shard(session, deltas, shard):
+    book_ids = sorted(deltas)
+    lock_shards(session, (stock.c.shard == shard) & stock.c.book_id.in_(book_ids))
+    delta = case(deltas, value=stock.c.book_id, else_=0)
+    return set(session.execute(
+        update(stock)
+        .where(stock.c.shard == shard, stock.c.book_id.in_(book_ids), stock.c.quantity + delta >= 0)
+        .values(quantity=stock.c.quantity + delta)
+        .returning(stock.c.book_id)
+    ).scalars())
+
+
+# Медленный путь для одной книги: возврат идёт в первый шард, списание собирается
+# из шардов по возрастанию номера. Книги без строк остатка нет на складе.
+def change_book(session, book_id, delta):
+    shards = [(shard, quantity) for _, shard, quantity in lock_shards(session, stock.c.book_id == book_id)]
+    if not shards:
+        if delta >= 0:
+            session.execute(insert(stock).values(book_id=book_id, shard=0, quantity=delta))
+        return delta >= 0
+    if delta >= 0:
+        session.execute(update(stock).where(stock.c.book_id == book_id, stock.c.shard == shards[0][0])
+                        .values(quantity=stock.c.quantity + delta))
+        return True
+    needed = -delta
+    if sum(quantity for _, quantity in shards) < needed:
+        return False
+    for shard, available in shards:
+        amount = min(available, needed)
+        if amount:
+            session.execute(update(stock).where(stock.c.book_id == book_id, stock.c.shard == shard)
+                            .values(quantity=stock.c.quantity - amount))
+            needed -= amount
+    return True
+
+
+# Применяет изменения остатков {book_id: delta} (delta < 0 — списание) и возвращает
+# id книг, которых не хватило; для них ничего не меняется. Обычно это три оператора
+# на любой размер корзины: случайный шард, блокировка строк и один UPDATE. Если в этом
+# шарде какой-то книги не хватает, быстрый путь откатывается до точки сохранения
+# (вместе с его блокировками) и все книги проходят медленный путь. Оба пути блокируют
+# строки в порядке (книга, шард) по возрастанию, поэтому взаимоблокировок нет.
+def apply_stock(session, deltas):
+    deltas = {book_id: delta for book_id, delta in deltas.items() if delta}
+    if not deltas:
+        return set()
+
+    savepoint = session.begin_nested()
+    rest = set(deltas) - change_in_shard(session, deltas, random.randrange(settings.STOCK_SHARDS))
+    if not rest:
+        savepoint.commit()
+        return set()
+    savepoint.rollback()
+
+    return {book_id for book_id in sorted(deltas) if not change_book(session, book_id, deltas[book_id])}
+
+
+# Снимает все резервации пользователя и истёкшие резервации нужных ему книг одним
+# DELETE ... RETURNING: каждая резервация возвращается на склад ровно один раз,
+# даже если её одновременно снимают несколько транзакций.
+# Возвращает действующие резервации пользователя и освободившиеся количества.
+def release_reservations(session, user_id, book_ids):
+    now = datetime.now()
+    rows = session.execute(
+        delete(reservations)
+        .where((reservations.c.user_id == user_id)
+               | (reservations.c.book_id.in_(book_ids) & (reservations.c.expires_at <= now)))
+        .returning(reservations.c.user_id, reservations.c.book_id, reservations.c.quantity,
+                   reservations.c.expires_at)
+    ).all()
+    held, freed = defaultdict(int), defaultdict(int)
+    for row in rows:
+        if row.user_id == user_id and row.expires_at > now:
+            held[row.book_id] += row.quantity
+        else:
+            freed[row.book_id] += row.quantity
+    return held, freed
+
+
+def stock_changes(wanted, held, freed):
+    return {book_id: held[book_id] + freed[book_id] - wanted.get(book_id, 0)
+            for book_id in set(wanted) | set(held) | set(freed)}
+
+
+def release_expired_reservations(session):
+    rows = session.execute(
+        delete(reservations).where(reservations.c.expires_at <= datetime.now())
+        .returning(reservations.c.book_id, reservations.c.quantity)
+    ).all()
+    freed = defaultdict(int)
+    for book_id, quantity in rows:
+        freed[book_id] += quantity
+    apply_stock(session, freed)
+    return sum(freed.values())
+
+
+# Резервирует корзину пользователя на RESERVATION_TTL секунд. Прежние резервации
+# пересчитываются: разница с корзиной списывается или возвращается. Книга резервируется
+# целиком или не резервируется совсем. Возвращает id книг, которых не хватает на складе.
+def reserve_cart(session, user_id):
+    wanted = dict(session.execute(
+        select(cart_items.c.book_id, cart_items.c.count).where(cart_items.c.user_id == user_id)
+    ).all())
+    held, freed = release_reservations(session, user_id, list(wanted))
+    changes = stock_changes(wanted, held, freed)
+    missing = apply_stock(session, changes)
+    if missing:
+        # Снятые резервации недостающих книг возвращаются на склад.
+        apply_stock(session, {book_id: held[book_id] + freed[book_id] for book_id in missing})
+
+    expires_at = datetime.now() + timedelta(seconds=settings.RESERVATION_TTL)
+    rows = [{'user_id': user_id, 'book_id': book_id, 'quantity': count, 'expires_at': expires_at}
+            for book_id, count in wanted.items() if book_id not in missing]
+    if rows:
+        session.execute(insert(reservations), rows)
+    return missing
+
+
+# Выкуп при оформлении заказа: резервации пользователя засчитываются, недостающее
+# списывается, лишнее возвращается. Если книг не хватает, OutOfStockError откатывает
+# всю транзакцию заказа.
+def claim_stock(session, user_id, quantities):
+    held, freed = release_reservations(session, user_id, list(quantities))
+    missing = apply_stock(session, stock_changes(quantities, held, freed))
+    if missing:
+        raise OutOfStockError(missing)
@@ -0,0 +1,146 @@
+from collections import defaultdict
+from datetime import date
+
+from sqlalchemy import delete, func, literal, select, tuple_, update
+
+from db.database import primary_session
+from db.models import Book, CartItem, Order, OrderItem
+from db.upsert import insert_for
+from services.inventory import claim_stock
+from services.cache import MISSING, cache
+from services.pagination import decode_cursor, encode_cursor
+from services.read_models import ORDER_COLUMNS, OrderRow, order_lines
+
+orders = Order.__table__
+order_items = OrderItem.__table__
+cart_items = CartItem.__table__
+books = Book.__table__
+
+
+class EmptyCartError(Exception):
+    pass
+
+
+# Заказ оформляется фиксированным числом операторов в одной транзакции,
+# независимо от количества позиций в корзине. Повтор с тем же ключом
+# идемпотентности (двойной клик, ретрай) возвращает уже созданный заказ.
+# Топ продаж и совместные покупки пополняет задача rollup-sales, а не оформление заказа.
+def place_order(session, user_id, idempotency_key, details):
+    today = date.today()
+    stmt = insert_for(session.get_bind(), orders).values(
+        user_id=user_id,
+        idempotency_key=idempotency_key,
+        date=today,
+        status='Оформлен',
+        total_amount=0,
+        **details
+    ).on_conflict_do_nothing(index_elements=[orders.c.user_id, orders.c.idempotency_key]).returning(orders.c.id)
+    order_id = session.execute(stmt).scalar()
+
+    if order_id is None:
+        existing_id = session.execute(
+            select(orders.c.id).where(orders.c.user_id == user_id, orders.c.idempotency_key == idempotency_key)
+        ).scalar()
+        return existing_id, False
+
+    lines = session.execute(
+        order_items.insert().from_select(
+            ['order_id', 'book_id', 'book_count', 'cost'],
+            select(literal(order_id), cart_items.c.book_id, cart_items.c.count, cart_items.c.count * books.c.price)
+            .join(books, books.c.id == cart_items.c.book_id)
+            .where(cart_items.c.user_id == user_id)
+        )
+    ).rowcount
+    if not lines:
+        raise EmptyCartError()
+
+    quantities = session.execute(
+        select(order_items.c.book_id, func.sum(order_items.c.book_count))
+        .where(order_items.c.order_id == order_id)
+        .group_by(order_items.c.book_id)
+    ).all()
+    claim_stock(session, user_id, dict(quantities))
+
+    session.execute(
+        update(orders)
+        .where(orders.c.id == order_id)
+        .values(total_amount=select(func.sum(order_items.c.cost))
+                .where(order_items.c.order_id == order_id)
+                .scalar_subquery())
+    )
+
+    session.execute(
+        delete(cart_items).where(
+            cart_items.c.user_id == user_id,
+            cart_items.c.book_id.in_(select(order_items.c.book_id).where(order_items.c.order_id == order_id))
+        )
+    )
+    return order_id, True
+
+
+def order_to_dict(order, lines):
+    items = [{
+        'book_count': line.book_count,
+        'cost': line.cost,
+        'book': line.book._asdict()
+    } for line in lines]
+    return {
+        'id': order.id,
+        'date': order.date.isoformat(),
+        'delivery_date': order.delivery_date,
+        'status': order.status,
+        'total_amount': order.total_amount,
+        'total_books': sum(item['book_count'] or 0 for item in items),
+        'items': items
+    }
+
+
+# Заказы страницы и все их позиции с книгами читаются двумя Core-запросами,
+# без загрузки ORM-объектов заказов, позиций и книг.
+def orders_to_dicts(session, query):
+    order_list = [OrderRow._make(row) for row in session.execute(query)]
+    lines = defaultdict(list)
+    for line in order_lines(session, [order.id for order in order_list]):
+        lines[line.order_id].append(line)
+    return [order_to_dict(order, lines[order.id]) for order in order_list]
+
+
+def fetch_orders_page(session, user_id, cursor=None, limit=20):
+    query = select(*ORDER_COLUMNS).where(orders.c.user_id == user_id)
+
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        try:
+            position = (date.fromisoformat(position[0]), position[1])
+        except (TypeError, ValueError):
+            position = None
+    if position:
+        query = query.where(tuple_(orders.c.date, orders.c.id) < tuple_(*position))
+
+    orders_page = orders_to_dicts(session, query.order_by(orders.c.date.desc(), orders.c.id.desc()).limit(limit + 1))
+
+    next_cursor = None
+    if len(orders_page) > limit:
+        orders_page = orders_page[:limit]
+        next_cursor = encode_cursor(orders_page[-1]['date'], orders_page[-1]['id'])
+
+    return orders_page, next_cursor
+
+
+# Ключ в пространстве 'books': рейтинг и описание книг в деталях заказа
+# устаревают вместе с каталогом. Как и карточки книг, кэш заполняется только
+# с основной базы, а отсутствие заказа не кэшируется: отстающая реплика или
+# ещё не зафиксированный заказ не должны отвечать «не найден» до истечения TTL.
+def get_order(session, user_id, order_id):
+    key = cache.key('books', 'order', user_id, order_id)
+    order = cache.get(key)
+    if order is not MISSING:
+        return order
+
+    with primary_session(session) as primary:
+        found = orders_to_dicts(primary, select(*ORDER_COLUMNS).where(orders.c.id == order_id,
+                                                                     orders.c.user_id == user_id))
+    if not found:
+        return None
+    cache.set(key, found[0])
+    return found[0]
@@ -0,0 +1,59 @@
+from collections import namedtuple
+
+from sqlalchemy import select
+
+from db.models import Book, CartItem, Order, OrderItem
+
+books = Book.__table__
+cart_items = CartItem.__table__
+orders = Order.__table__
+order_items = OrderItem.__table__
+
+# Строки списков выбираются Core-запросами ровно из тех колонок, которые показывают
+# шаблоны, и сразу становятся неизменяемыми namedtuple: без identity map, состояния
+# ORM-объектов и перекладывания в словари. Шаблоны читают поля как атрибуты.
+BookCard = namedtuple('BookCard', ['id', 'title', 'author', 'genre', 'rating', 'rating_count', 'year', 'price',
+                                   'cover', 'description'])
+BestsellerCard = namedtuple('BestsellerCard', BookCard._fields + ('total_sold',))
+CartBook = namedtuple('CartBook', ['id', 'title', 'author', 'price', 'rating', 'rating_count', 'cover'])
+CartLine = namedtuple('CartLine', ['book', 'count'])
+OrderBook = namedtuple('OrderBook', ['id', 'title', 'author', 'cover', 'genre', 'year', 'rating', 'rating_count',
+                                     'description'])
+OrderLine = namedtuple('OrderLine', ['order_id', 'book_count', 'cost', 'book'])
+OrderRow = namedtuple('OrderRow', ['id', 'date', 'delivery_date', 'status', 'total_amount'])
+
+
+def book_columns(row_type):
+    return [books.c[field] for field in row_type._fields]
+
+
+BOOK_CARD_COLUMNS = book_columns(BookCard)
+ORDER_COLUMNS = [orders.c[field] for field in OrderRow._fields]
+
+
+def book_cards_by_id(session, book_ids):
+    rows = session.execute(select(*BOOK_CARD_COLUMNS).where(books.c.id.in_(book_ids)))
+    return {row.id: BookCard._make(row) for row in rows}
+
+
+def cart_lines(session, user_id):
+    rows = session.execute(
+        select(cart_items.c.count, *book_columns(CartBook))
+        .join(books, books.c.id == cart_items.c.book_id)
+        .where(cart_items.c.user_id == user_id)
+        .order_by(cart_items.c.book_id)
+    )
+    return [CartLine(CartBook._make(row[1:]), row[0]) for row in rows]
+
+
+# Позиции всех заказов страницы — один запрос с книгами, а не selectinload двух связей.
+def order_lines(session, order_ids):
+    if not order_ids:
+        return []
+    rows = session.execute(
+        select(order_items.c.order_id, order_items.c.book_count, order_items.c.cost, *book_columns(OrderBook))
+        .join(books, books.c.id == order_items.c.book_id)
+        .where(order_items.c.order_id.in_(order_ids))
+        .order_by(order_items.c.order_id, order_items.c.id)
+    )
+    return [OrderLine(row[0], row[1], row[2], OrderBook._make(row[3:])) for row in rows]
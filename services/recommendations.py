@@ -0,0 +1,133 @@
+from collections import defaultdict
+
+from sqlalchemy import and_, delete, func, insert, select
+from sqlalchemy.orm import aliased
+
+from config import settings
+from db.changes import notify_changed, on_changed
+from db.database import primary_session, session_scope
+from db.models import BookCoPurchase, BookCoPurchaseStaging, OrderItem
+from db.upsert import insert_for
+from services.analytics import get_watermark
+from services.cache import MISSING, cache, create_cache
+from services.catalog import get_book_cards
+
+copurchases = BookCoPurchase.__table__
+staging = BookCoPurchaseStaging.__table__
+WATERMARK = 'copurchases'
+neighbour_cache = create_cache('recommendations', settings.RECOMMENDATIONS_CACHE_MAX_ENTRIES)
+
+
+def copurchase_pairs(order_filter):
+    left, right = aliased(OrderItem), aliased(OrderItem)
+    return select(left.book_id, right.book_id, func.count(func.distinct(left.order_id))) \
+        .join(right, and_(right.order_id == left.order_id, right.book_id != left.book_id)) \
+        .where(order_filter(left)) \
+        .group_by(left.book_id, right.book_id)
+
+
+def upsert_pairs(session, pairs, table=copurchases):
+    stmt = insert_for(session.get_bind(), table).from_select(['book_id', 'other_id', 'orders'], pairs)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[table.c.book_id, table.c.other_id],
+        set_={'orders': table.c.orders + stmt.excluded.orders}
+    )
+    session.execute(stmt)
+
+
+# Матрица пополняется задачей rollup-sales тем же оператором, что и пересборка,
+# но только по парам заказов диапазона (low_id, high_id].
+def add_copurchases(session, low_id, high_id):
+    in_range = lambda item: and_(item.order_id > low_id, item.order_id <= high_id)
+    upsert_pairs(session, copurchase_pairs(in_range))
+    book_ids = session.execute(select(OrderItem.book_id.distinct()).where(in_range(OrderItem))).scalars()
+    notify_changed(session, 'copurchases', book_ids)
+
+
+# Заказы до watermark (максимального id на момент запуска) обрабатываются диапазонами
+# в staging-таблицу с фиксацией после каждого, поэтому пересборка не держит всю историю
+# ни в памяти, ни в одной транзакции. Рабочая матрица всё это время отдаёт рекомендации.
+# Подмена — одна транзакция: матрица заменяется staging-таблицей, к ней добавляются пары
+# заказов после watermark, и watermark задачи rollup-sales ставится на последний
+# учтённый заказ, так что каждый заказ учтён ровно один раз.
+def rebuild_copurchases(chunk_size=None, progress=None):
+    chunk_size = chunk_size or settings.COPURCHASE_REBUILD_CHUNK
+    with session_scope() as session:
+        session.execute(delete(staging))
+        first, last = session.query(func.min(OrderItem.order_id), func.max(OrderItem.order_id)).one()
+
+    if first is not None:
+        for start in range(first, last + 1, chunk_size):
+            end = min(start + chunk_size, last + 1)
+            with session_scope() as session:
+                upsert_pairs(session, copurchase_pairs(
+                    lambda item: and_(item.order_id >= start, item.order_id < end)), staging)
+            if progress:
+                progress(f'orders {start}..{end - 1} of {last}')
+
+    staged = last or 0
+    with session_scope() as session:
+        last_id = session.query(func.max(OrderItem.order_id)).scalar() or 0
+        session.execute(delete(copurchases))
+        session.execute(insert(copurchases).from_select(['book_id', 'other_id', 'orders'],
+                                                        select(staging.c.book_id, staging.c.other_id,
+                                                               staging.c.orders)))
+        upsert_pairs(session, copurchase_pairs(lambda item: and_(item.order_id > staged, item.order_id <= last_id)))
+        session.execute(delete(staging))
+        watermark = get_watermark(session, WATERMARK)
+        watermark.last_id = watermark.seen_id = last_id
+
+    neighbour_cache.clear()
+    cache.bump('books')
+
+
+# Топ соседей всех книг без кэша читается одним запросом: номер соседа внутри
+# книги считается оконной функцией, поэтому корзина не даёт запроса на каждую книгу.
+def neighbours_by_id(session, book_ids):
+    found = {}
+    for book_id in book_ids:
+        cached = neighbour_cache.get(f'neighbours:{book_id}')
+        if cached is not MISSING:
+            found[book_id] = cached
+
+    missing = [book_id for book_id in book_ids if book_id not in found]
+    if missing:
+        rank = func.row_number().over(
+            partition_by=copurchases.c.book_id,
+            order_by=(copurchases.c.orders.desc(), copurchases.c.other_id.desc())
+        ).label('rank')
+        ranked = select(copurchases.c.book_id, copurchases.c.other_id, copurchases.c.orders, rank) \
+            .where(copurchases.c.book_id.in_(missing)).subquery()
+        loaded = {book_id: [] for book_id in missing}
+        with primary_session(session) as primary:
+            rows = primary.execute(
+                select(ranked.c.book_id, ranked.c.other_id, ranked.c.orders)
+                .where(ranked.c.rank <= settings.RECOMMENDATIONS_TOP_K)
+                .order_by(ranked.c.book_id, ranked.c.rank)
+            )
+            for book_id, other_id, orders in rows:
+                loaded[book_id].append((other_id, orders))
+        for book_id, result in loaded.items():
+            neighbour_cache.set(f'neighbours:{book_id}', result, settings.RECOMMENDATIONS_CACHE_TTL)
+        found.update(loaded)
+    return found
+
+
+# Для нескольких книг (корзина) веса соседей складываются; сами книги
+# из рекомендаций исключаются.
+def recommended_books(session, book_ids, limit=4):
+    scores = defaultdict(int)
+    for result in neighbours_by_id(session, book_ids).values():
+        for other_id, orders in result:
+            scores[other_id] += orders
+    for book_id in book_ids:
+        scores.pop(book_id, None)
+    ranked = sorted(scores, key=lambda other_id: (-scores[other_id], -other_id))[:limit]
+    return get_book_cards(session, ranked)
+
+
+@on_changed('copurchases')
+def invalidate_neighbours(book_ids):
+    for book_id in book_ids:
+        neighbour_cache.delete(f'neighbours:{book_id}')
+        cache.delete(cache.key('books', 'detail', book_id))
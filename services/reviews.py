@@ -0,0 +1,48 @@
+from sqlalchemy import Float, cast, func, select, update
+
+from db.changes import notify_books_changed
+from db.models import Book, Review
+from db.upsert import insert_for
+
+books = Book.__table__
+reviews = Review.__table__
+
+
+class DuplicateReviewError(Exception):
+    pass
+
+
+# Средний рейтинг пересчитывается одним UPDATE прямо в базе: параллельные отзывы
+# не теряют обновлений, а блокировка строки книги держится только до коммита.
+def add_review(session, user_id, book_id, rating, text):
+    stmt = insert_for(session.get_bind(), reviews).values(
+        user_id=user_id,
+        book_id=book_id,
+        rating=rating,
+        review=text
+    ).on_conflict_do_nothing(
+        index_elements=[reviews.c.user_id, reviews.c.book_id],
+        index_where=reviews.c.parent_review_id.is_(None)
+    ).returning(reviews.c.id)
+    if session.execute(stmt).scalar() is None:
+        raise DuplicateReviewError()
+
+    rating_count = func.coalesce(books.c.rating_count, 0)
+    session.execute(
+        update(books)
+        .where(books.c.id == book_id)
+        .values(rating=(func.coalesce(books.c.rating, cast(0, Float)) * rating_count + rating) / (rating_count + 1),
+                rating_count=rating_count + 1)
+    )
+    notify_books_changed(session, [book_id])
+
+
+def recompute_ratings(session):
+    book_reviews = (Review.book_id == books.c.id, Review.rating.isnot(None), Review.parent_review_id.is_(None))
+    session.execute(
+        update(books).values(
+            rating=select(func.avg(cast(Review.rating, Float))).where(*book_reviews).scalar_subquery(),
+            rating_count=select(func.count(Review.rating)).where(*book_reviews).scalar_subquery()
+        )
+    )
+    notify_books_changed(session, [book_id for book_id, in session.execute(select(books.c.id))])
@@ -0,0 +1,211 @@
+import re
+import threading
+from bisect import bisect_left
+from collections import defaultdict
+
+from sqlalchemy import text
+
+from db.changes import BookChangeFeed, on_books_changed
+from db.database import primary_session
+from db.models import Book
+from services.catalog import get_book_cards
+
+FIELD_WEIGHTS = {'title': 3.0, 'author': 2.0, 'genre': 1.5, 'description': 1.0}
+PREFIX_WEIGHT = 0.8
+FUZZY_WEIGHT = 0.6
+FUZZY_THRESHOLD = 0.4
+MIN_PREFIX_LENGTH = 2
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Выражение должно совпадать с индексом idx_books_search, иначе PostgreSQL его не использует.
+PG_SEARCH_VECTOR = (
+    "setweight(to_tsvector('russian', replace(lower(title), 'ё', 'е')), 'A') || "
+    "setweight(to_tsvector('russian', replace(lower(author), 'ё', 'е')), 'B') || "
+    "setweight(to_tsvector('russian', replace(lower(genre), 'ё', 'е')), 'C') || "
+    "setweight(to_tsvector('russian', replace(lower(description), 'ё', 'е')), 'D')"
+)
+
+
+def normalize(value):
+    return (value or '').casefold().replace('ё', 'е')
+
+
+def tokenize(value):
+    return TOKEN_RE.findall(normalize(value))
+
+
+def trigrams(token):
+    padded = f'  {token} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class InvertedIndex:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.changes = BookChangeFeed()
+        self._reset()
+
+    def _reset(self):
+        self.loaded = False
+        self.pending = set()
+        self.postings = defaultdict(dict)
+        self.doc_terms = {}
+        self.vocabulary = []
+        self.term_trigrams = {}
+        self.trigram_terms = defaultdict(set)
+
+    def load(self, session):
+        with self.lock:
+            self._reset()
+            for row in session.query(Book.id, Book.title, Book.author, Book.genre, Book.description):
+                self._add(row)
+            self.vocabulary.sort()
+            self.loaded = True
+
+    def mark_changed(self, book_ids):
+        with self.lock:
+            self.pending.update(book_ids)
+
+    # Как и фасетный индекс: свои изменения применяются сразу, чужие (другие воркеры,
+    # import-books) — по журналу book_changes.
+    def refresh(self, session):
+        with self.lock:
+            if self.loaded and not self.pending and not self.changes.due():
+                return
+            with primary_session(session) as session:
+                if self.loaded and self.changes.due():
+                    changed = self.changes.read(session)
+                    if changed is None:
+                        self.loaded = False
+                    else:
+                        self.pending.update(changed)
+                if not self.loaded or len(self.pending) > max(1000, len(self.doc_terms) // 10):
+                    self.changes.reset(session)
+                    self.load(session)
+                    return
+                if not self.pending:
+                    return
+                book_ids, self.pending = self.pending, set()
+                for book_id in book_ids:
+                    self._remove(book_id)
+                rows = session.query(Book.id, Book.title, Book.author, Book.genre, Book.description) \
+                    .filter(Book.id.in_(book_ids)).all()
+            for row in rows:
+                self._add(row)
+            self.vocabulary.sort()
+
+    def _add(self, row):
+        weights = defaultdict(float)
+        for field, weight in FIELD_WEIGHTS.items():
+            for token in tokenize(getattr(row, field)):
+                weights[token] = max(weights[token], weight)
+
+        for token, weight in weights.items():
+            if token not in self.postings:
+                self.vocabulary.append(token)
+                self.term_trigrams[token] = trigrams(token)
+                for gram in self.term_trigrams[token]:
+                    self.trigram_terms[gram].add(token)
+            self.postings[token][row.id] = weight
+        self.doc_terms[row.id] = set(weights)
+
+    def _remove(self, book_id):
+        for token in self.doc_terms.pop(book_id, ()):
+            docs = self.postings[token]
+            docs.pop(book_id, None)
+            if not docs:
+                del self.postings[token]
+                self.vocabulary.remove(token)
+                for gram in self.term_trigrams.pop(token):
+                    self.trigram_terms[gram].discard(token)
+
+    def _expand(self, token):
+        terms = {}
+        if token in self.postings:
+            terms[token] = 1.0
+
+        if len(token) >= MIN_PREFIX_LENGTH:
+            position = bisect_left(self.vocabulary, token)
+            while position < len(self.vocabulary) and self.vocabulary[position].startswith(token):
+                terms.setdefault(self.vocabulary[position], PREFIX_WEIGHT)
+                position += 1
+
+        query_grams = trigrams(token)
+        candidates = defaultdict(int)
+        for gram in query_grams:
+            for term in self.trigram_terms.get(gram, ()):
+                candidates[term] += 1
+        for term, shared in candidates.items():
+            similarity = shared / (len(query_grams) + len(self.term_trigrams[term]) - shared)
+            if similarity >= FUZZY_THRESHOLD:
+                terms.setdefault(term, similarity * FUZZY_WEIGHT)
+        return terms
+
+    def search(self, query):
+        tokens = tokenize(query)
+        if not tokens:
+            return []
+
+        with self.lock:
+            scores = defaultdict(float)
+            matched = defaultdict(int)
+            for token in tokens:
+                best = {}
+                for term, term_weight in self._expand(token).items():
+                    for book_id, field_weight in self.postings[term].items():
+                        best[book_id] = max(best.get(book_id, 0), term_weight * field_weight)
+                for book_id, score in best.items():
+                    scores[book_id] += score
+                    matched[book_id] += 1
+
+        # Книги, совпавшие со всеми словами запроса, всегда выше частичных совпадений.
+        ranked = sorted(scores, key=lambda book_id: (-matched[book_id], -scores[book_id], book_id))
+        return ranked
+
+
+index = InvertedIndex()
+on_books_changed(index.mark_changed)
+
+
+def pg_search_ids(session, query):
+    tokens = tokenize(query)
+    if not tokens:
+        return []
+    ts_query = ' & '.join(f'{token}:*' for token in tokens)
+    normalized = ' '.join(tokens)
+    rows = session.execute(text(f"""
+        SELECT id FROM books
+        WHERE ({PG_SEARCH_VECTOR}) @@ to_tsquery('russian', :ts_query)
+           OR replace(lower(title), 'ё', 'е') % :query
+           OR replace(lower(author), 'ё', 'е') % :query
+        ORDER BY ts_rank({PG_SEARCH_VECTOR}, to_tsquery('russian', :ts_query))
+               + similarity(replace(lower(title), 'ё', 'е'), :query) DESC, id
+        LIMIT 1000
+    """), {'ts_query': ts_query, 'query': normalized})
+    return [row.id for row in rows]
+
+
+def ensure_search_indexes(engine):
+    if engine.dialect.name != 'postgresql':
+        return
+    with engine.begin() as connection:
+        connection.execute(text('CREATE EXTENSION IF NOT EXISTS pg_trgm'))
+        connection.execute(text(f'CREATE INDEX IF NOT EXISTS idx_books_search ON books USING gin (({PG_SEARCH_VECTOR}))'))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_books_title_trgm ON books "
+                                "USING gin ((replace(lower(title), 'ё', 'е')) gin_trgm_ops)"))
+        connection.execute(text("CREATE INDEX IF NOT EXISTS idx_books_author_trgm ON books "
+                                "USING gin ((replace(lower(author), 'ё', 'е')) gin_trgm_ops)"))
+
+
+def search_books(session, query, page=1, per_page=24):
+    if session.get_bind().dialect.name == 'postgresql':
+        book_ids = pg_search_ids(session, query)
+    else:
+        index.refresh(session)
+        book_ids = index.search(query)
+
+    total = len(book_ids)
+    page_ids = book_ids[(page - 1) * per_page:page * per_page]
+    return get_book_cards(session, page_ids), total
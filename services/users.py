@@ -0,0 +1,52 @@
+from flask_login import UserMixin
+
+from config import settings
+from db.changes import on_changed
+from db.models import User
+from services.cache import MISSING, create_cache
+
+user_cache = create_cache('users', settings.USER_CACHE_MAX_ENTRIES)
+
+
+# Отсоединённый от сессии снимок пользователя: только то, что нужно шаблонам
+# и маршрутам, без password_hash и ленивых связей.
+class UserSnapshot(UserMixin):
+
+    def __init__(self, id, username, user_phone, email):
+        self.id = id
+        self.username = username
+        self.user_phone = user_phone
+        self.email = email
+
+
+def load_user_snapshot(session, user_id):
+    if not str(user_id).isdigit():
+        return None
+    key = f'user:{user_id}'
+    snapshot = user_cache.get(key)
+    if snapshot is not MISSING:
+        return snapshot
+
+    row = session.query(User.id, User.username, User.user_phone, User.email) \
+        .filter(User.id == int(user_id)).first()
+    snapshot = UserSnapshot(*row) if row else None
+    if snapshot:
+        user_cache.set(key, snapshot, settings.USER_CACHE_TTL)
+    return snapshot
+
+
+def is_admin(user):
+    if not user.is_authenticated:
+        return False
+    admins = {email.strip().lower() for email in settings.ADMIN_EMAILS.split(',') if email.strip()}
+    return user.email.lower() in admins
+
+
+def forget_user(user_id):
+    user_cache.delete(f'user:{user_id}')
+
+
+@on_changed('users')
+def invalidate_users(user_ids):
+    for user_id in user_ids:
+        forget_user(user_id)